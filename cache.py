@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Small thread safe LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
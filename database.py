@@ -1,4 +1,17 @@
-from sqlmodel import Session, create_engine, text
+from contextlib import asynccontextmanager
+import logging
+import time
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from metrics import db_pool_wait_seconds, db_query_seconds
+from settings import get_settings
+from timing import add_timing
+
+settings = get_settings()
 
 # from sqlalchemy.ext.compiler import compiles
 # from sqlalchemy.sql.ddl import CreateTable
@@ -19,16 +32,92 @@ from sqlmodel import Session, create_engine, text
 
 sqlite_file_name = "datastore/master.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
+sqlite_async_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
 connect_args = {"check_same_thread": False}  # special case for SQLite
 
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+pool_args = {
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_timeout": settings.DB_POOL_TIMEOUT,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+    "pool_pre_ping": settings.DB_POOL_PRE_PING,
+}
+
+sqlite_pragmas = (
+    f"PRAGMA journal_mode = {settings.SQLITE_JOURNAL_MODE}",
+    f"PRAGMA synchronous = {settings.SQLITE_SYNCHRONOUS}",
+    f"PRAGMA cache_size = {int(settings.SQLITE_CACHE_SIZE)}",
+    f"PRAGMA mmap_size = {int(settings.SQLITE_MMAP_SIZE)}",
+    f"PRAGMA temp_store = {settings.SQLITE_TEMP_STORE}",
+    f"PRAGMA busy_timeout = {int(settings.SQLITE_BUSY_TIMEOUT)}",
+    "PRAGMA foreign_keys = on",
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply the tuned PRAGMAs to every new pooled connection"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in sqlite_pragmas:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    add_timing("db", duration)
+    db_query_seconds.observe(duration)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection"""
 
+    metrics_label = "sync"
 
-with Session(engine) as session:
-    session.exec(text("PRAGMA journal_mode = WAL"))
-    session.exec(text("PRAGMA synchronous = normal"))
-    session.exec(text("PRAGMA foreign_keys = on"))
-    session.commit()
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait_seconds.observe(
+                time.perf_counter() - start, engine=self.metrics_label
+            )
+
+
+class TimedAsyncAdaptedQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    metrics_label = "async"
+
+
+# SQLAlchemy names a pool logger after the pool class, so these log as
+# "database.<class>" and not below the quiet "sqlalchemy" logger, keep them at
+# the level of the stock pools
+for pool_class in (TimedQueuePool, TimedAsyncAdaptedQueuePool):
+    logging.getLogger(f"{__name__}.{pool_class.__name__}").setLevel(
+        logging.INFO if settings.SQL_ECHO else logging.WARNING
+    )
+
+
+engine = create_engine(
+    sqlite_url,
+    connect_args=connect_args,
+    poolclass=TimedQueuePool,
+    **pool_args,
+)
+event.listen(engine, "connect", set_sqlite_pragmas)
+event.listen(engine, "before_cursor_execute", before_cursor_execute)
+event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+async_engine = create_async_engine(
+    sqlite_async_url, poolclass=TimedAsyncAdaptedQueuePool, **pool_args
+)
+event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+event.listen(async_engine.sync_engine, "after_cursor_execute", after_cursor_execute)
 
 
 def get_db():
@@ -42,3 +131,14 @@ def get_db():
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+@asynccontextmanager
+async def async_session_scope():
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+async def get_async_session():
+    async with async_session_scope() as session:
+        yield session
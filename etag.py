@@ -0,0 +1,35 @@
+import hashlib
+
+from fastapi import Request, Response, status
+
+# clients may keep the response but have to revalidate it on every use
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag from the table versions (and anything else the
+    representation depends on, like the query string)"""
+    raw = "\x1f".join(str(part) for part in parts).encode("utf-8")
+    return '"' + hashlib.blake2b(raw, digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 asks for GET)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag for candidate in header.split(",")
+    )
+
+
+def etag_headers(etag: str) -> dict[str, str]:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag)
+    )
@@ -0,0 +1,54 @@
+# Gunicorn production profile, used by serve.py:
+#   gunicorn -c gunicorn.conf.py main:app
+# Every value can be overridden from the environment.
+import multiprocessing
+import os
+
+# production defaults for the app settings
+os.environ.setdefault("DEV_MODE", "false")
+
+bind = os.getenv("BIND", "0.0.0.0:8888")
+
+# async workers: one per core is enough to saturate the host
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicornworker.CustomUvicornWorker"
+
+backlog = int(os.getenv("BACKLOG", 2048))
+keepalive = int(os.getenv("KEEPALIVE", 5))
+timeout = int(os.getenv("TIMEOUT", 60))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+
+# recycle workers now and then, the jitter keeps them from restarting together
+max_requests = int(os.getenv("MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", 1000))
+
+# import the app once in the master and fork it, workers start faster and
+# share the read-only pages
+preload_app = os.getenv("PRELOAD_APP", "true").lower() in ("1", "true", "yes")
+
+accesslog = os.getenv("ACCESSLOG") or None
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+def on_starting(server):
+    # per worker metric snapshots from an earlier run would be summed in
+    metrics_dir = os.getenv("METRICS_DIR")
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            if name.startswith("metrics_"):
+                os.remove(os.path.join(metrics_dir, name))
+
+
+def post_fork(server, worker):
+    # nothing created by the master at import may be shared with a worker:
+    # drop inherited pooled connections and restart the logging thread
+    if not preload_app:
+        return
+
+    from database import async_engine, engine
+    from logger import restart_logging_after_fork
+
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+    restart_logging_after_fork()
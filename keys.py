@@ -0,0 +1,159 @@
+"""JWT signing keys, parsed once per process
+
+With an HS* `JWT_ALGO` tokens are signed with `JWT_SECRET` as before. With
+EdDSA or ES256 the keys are PEM files in `JWT_KEYS_DIR`, the file name is the
+key id (`kid`): `<kid>.pem` holds a private key, `<kid>.pub.pem` only the
+public key of a retired key that still has to verify unexpired tokens.
+`JWT_ACTIVE_KID` picks the signing key (default: the last private key by
+name). To rotate, add a new key, switch the active kid and keep the old one
+(or only its public key) until its tokens have expired:
+
+    python keys.py generate <kid>
+"""
+
+from functools import lru_cache
+from pathlib import Path
+import sys
+
+import jwt
+
+from settings import get_settings
+
+settings = get_settings()
+
+# optional, only needed for the asymmetric algorithms
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+    from jwt.algorithms import ECAlgorithm, OKPAlgorithm
+except ImportError:
+    serialization = None
+
+ASYMMETRIC_ALGORITHMS = ("EdDSA", "ES256")
+
+
+class KeySet:
+    """Signing key plus every key that may verify a token, with the JWKS
+    document of the public keys prebuilt"""
+
+    def __init__(self, algorithm: str, signing_key, kid: str | None, keys: dict):
+        self.algorithm = algorithm
+        self.signing_key = signing_key
+        self.kid = kid
+        self.headers = {"kid": kid} if kid else None
+        self.keys = keys
+        self.jwks = {
+            "keys": [_public_jwk(algorithm, kid, key) for kid, key in keys.items()]
+        }
+
+    def verification_key(self, token: str):
+        """Parsed key for the `kid` in the token header"""
+        if self.kid is None:
+            return self.signing_key
+        kid = jwt.get_unverified_header(token).get("kid")
+        try:
+            return self.keys[kid]
+        except KeyError:
+            raise jwt.InvalidKeyError(f"Unknown key id: {kid}")
+
+
+def _public_jwk(algorithm: str, kid: str, key) -> dict:
+    if algorithm == "EdDSA":
+        jwk = OKPAlgorithm.to_jwk(key, as_dict=True)
+    else:
+        jwk = ECAlgorithm.to_jwk(key, as_dict=True)
+    jwk.update({"kid": kid, "alg": algorithm, "use": "sig"})
+    return jwk
+
+
+def _check_key_type(algorithm: str, kid: str, key):
+    if algorithm == "EdDSA":
+        valid = isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey))
+    else:
+        valid = isinstance(
+            key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)
+        ) and isinstance(key.curve, ec.SECP256R1)
+    if not valid:
+        raise RuntimeError(f"Key {kid} can not be used with {algorithm}")
+
+
+@lru_cache()
+def get_key_set() -> KeySet:
+    """Loaded on first use, then shared by every request"""
+    algorithm = settings.JWT_ALGO
+
+    if algorithm not in ASYMMETRIC_ALGORITHMS:
+        return KeySet(algorithm, settings.JWT_SECRET, None, {})
+
+    if serialization is None:
+        raise RuntimeError(
+            f"{algorithm} JWT signing needs cryptography: pip install pyjwt[crypto]"
+        )
+
+    private_keys, public_keys = {}, {}
+    for path in sorted(Path(settings.JWT_KEYS_DIR).glob("*.pem")):
+        data = path.read_bytes()
+        if path.name.endswith(".pub.pem"):
+            kid = path.name.removesuffix(".pub.pem")
+            public_keys[kid] = serialization.load_pem_public_key(data)
+        else:
+            kid = path.name.removesuffix(".pem")
+            private_keys[kid] = serialization.load_pem_private_key(data, None)
+            public_keys[kid] = private_keys[kid].public_key()
+        _check_key_type(algorithm, kid, public_keys[kid])
+
+    if not private_keys:
+        raise RuntimeError(f"No private keys in JWT_KEYS_DIR {settings.JWT_KEYS_DIR}")
+
+    kid = settings.JWT_ACTIVE_KID or list(private_keys)[-1]
+    if kid not in private_keys:
+        raise RuntimeError(f"JWT_ACTIVE_KID {kid} has no private key")
+
+    return KeySet(algorithm, private_keys[kid], kid, public_keys)
+
+
+def generate_key(kid: str) -> Path:
+    """Write a new private key for JWT_ALGO to JWT_KEYS_DIR/<kid>.pem"""
+    if settings.JWT_ALGO not in ASYMMETRIC_ALGORITHMS:
+        raise RuntimeError(
+            f"JWT_ALGO {settings.JWT_ALGO} signs with JWT_SECRET, set it to one of "
+            f"{', '.join(ASYMMETRIC_ALGORITHMS)} to use key files"
+        )
+    if serialization is None:
+        raise RuntimeError(
+            f"{settings.JWT_ALGO} JWT signing needs cryptography: "
+            "pip install pyjwt[crypto]"
+        )
+
+    if settings.JWT_ALGO == "EdDSA":
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        key = ec.generate_private_key(ec.SECP256R1())
+
+    path = Path(settings.JWT_KEYS_DIR) / f"{kid}.pem"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "xb") as file:
+        file.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    path.chmod(0o600)
+    return path
+
+
+# refresh tokens never leave this app, they stay HMAC signed
+refresh_algorithm = (
+    settings.JWT_ALGO if settings.JWT_ALGO not in ASYMMETRIC_ALGORITHMS else "HS256"
+)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "generate":
+        sys.exit("usage: python keys.py generate <kid>")
+    try:
+        print(generate_key(sys.argv[2]))
+    except (RuntimeError, FileExistsError) as ex:
+        sys.exit(str(ex))
@@ -0,0 +1,86 @@
+from datetime import datetime, timezone
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+from settings import get_settings
+
+settings = get_settings()
+
+_listener: logging.handlers.QueueListener | None = None
+_queue: queue.SimpleQueue | None = None
+_handler: logging.Handler | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def setup_logging():
+    """Route all logging through a queue, the actual stream writes happen on
+    the QueueListener background thread so request code never blocks on I/O"""
+    global _queue, _handler
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    if settings.LOG_JSON:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+
+    _handler = handler
+    _queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(_queue))
+    root.setLevel(settings.LOG_LEVEL.upper())
+
+    if settings.SQL_ECHO:
+        logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+
+    _start_listener()
+    atexit.register(stop_logging)
+
+
+def _start_listener():
+    global _listener
+    _listener = logging.handlers.QueueListener(
+        _queue, _handler, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def restart_logging_after_fork():
+    """The listener thread does not survive fork(), start a new one in the
+    child (used by the gunicorn post_fork hook when the app is preloaded)"""
+    if _queue is not None:
+        _start_listener()
+
+
+def stop_logging():
+    """Flush whatever is still queued and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    setup_logging()
+    return logging.getLogger(name)
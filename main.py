@@ -1,77 +1,125 @@
 from contextlib import asynccontextmanager
-import time
+import hmac
+import math
 from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
 from fastapi.applications import HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from sqlmodel import SQLModel, Session, select, text
-from database import engine, get_session
-from models.base import Role, TokenData, User
+from logger import get_logger
+from database import (
+    AsyncSession,
+    async_engine,
+    engine,
+    get_async_session,
+    get_session,
+)
+from models.base import RefreshRequest, Role, TokenData, User
 
 from oauth import (
     create_access_token,
     create_refresh_token,
-    get_current_user,
+    decode_refresh_token,
     get_current_user_from_cookie,
+    principal_claims,
 )
+from keys import get_key_set
+from ratelimit import get_login_limiter
 from settings import get_settings
-from utils import verify_password
+from templating import precompile_templates, templates
+from utils import (
+    hash_password_async,
+    needs_rehash,
+    shutdown_password_executor,
+    verify_password_async,
+)
+from metrics import login_attempts, registry, render_metrics, token_refreshes
+from middleware import MetricsMiddleware, PrincipalMiddleware
+from repository.bootstrap import is_initialized
+from repository.revocation import (
+    family_expires,
+    family_key,
+    is_revoked_async,
+    purge_revoked_tokens,
+    revoke_async,
+)
+from repository.version import bump_version, bump_version_async
 from routes.user import userRouter
 from routes.role import roleRouter
 from routes.webuser import webuserRouter
 from routes.webrole import webroleRouter
 
-
 settings = get_settings()
 
+logger = get_logger(__name__)
+
 menu = [{"Users": "users"}, {"Roles": "roles"}]
 
 cookie_name = settings.COOKIE_NAME
 
+refresh_cookie_name = settings.REFRESH_COOKIE_NAME
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("Startup...(code here for startup stuff...)")
-    print(f"--> App Version: {app.version}")
+    logger.info("Startup...(code here for startup stuff...)")
+    logger.info("--> App Version: %s", app.version)
 
     with Session(engine) as session:
         tables = session.exec(
             text("SELECT name FROM sqlite_master WHERE type='table'")
         ).all()
 
+        SQLModel.metadata.tables["tableversion"].create(engine, checkfirst=True)
+        SQLModel.metadata.tables["revokedtoken"].create(engine, checkfirst=True)
+        SQLModel.metadata.tables["ratelimitbucket"].create(engine, checkfirst=True)
+        purge_revoked_tokens(session)
+
         if not any(filter(lambda table: table.name == "role", tables)):
             try:
                 SQLModel.metadata.tables["role"].create(engine)
                 newRole = Role(name="Superuser")
                 session.add(newRole)
+                bump_version(session, "role")
                 session.commit()
             except Exception as ex:
                 if "already exists" not in str(ex):
-                    print("lifespan Role create", ex)
+                    logger.error("lifespan Role create %s", ex)
 
         if not any(filter(lambda table: table.name == "user", tables)):
             try:
                 SQLModel.metadata.tables["user"].create(engine)
             except Exception as ex:
                 if "already exists" not in str(ex):
-                    print("lifespan User create", ex)
+                    logger.error("lifespan User create %s", ex)
+
+        # indexes added after the table was first created
+        for index in SQLModel.metadata.tables["user"].indexes:
+            index.create(engine, checkfirst=True)
+
+    get_key_set()
+    await get_login_limiter().purge()
+    precompile_templates()
+    registry.start_flusher()
 
     yield
-    print("Shutting down...")
+    logger.info("Shutting down...")
+    registry.stop_flusher()
     with Session(engine) as session:
         session.exec(text("PRAGMA analysis_limit=400"))
         session.exec(text("PRAGMA optimize"))
         session.commit()
         engine.dispose()
-    print("Shutdown")
+    await async_engine.dispose()
+    shutdown_password_executor()
+    logger.info("Shutdown")
 
 
 description = "Sample FastAPI with SQLModel, Jinja2 Templating with HTMX and PICOCss"
 version = "00.01.00"
-devmode = True
+devmode = settings.DEV_MODE
 
 app = FastAPI(
     title="Demo",
@@ -83,7 +131,6 @@ app = FastAPI(
 
 app.mount("/static", StaticFiles(directory="www/static"), name="static")
 
-templates = Jinja2Templates(directory="www/templates")
 
 origins = ["*"]
 
@@ -96,101 +143,27 @@ app.add_middleware(
     max_age=86400,
 )
 
+app.add_middleware(PrincipalMiddleware, cookie_name=cookie_name)
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(userRouter)
 app.include_router(roleRouter)
 app.include_router(webuserRouter)
 app.include_router(webroleRouter)
 
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    """
-    Middleware function that adds a process time header to the HTTP response.
-
-    Parameters:
-    - request: The incoming HTTP request object.
-    - call_next: The function to call to proceed with the request handling.
-
-    Returns:
-    - The HTTP response object.
-
-    Description:
-    This function is a middleware that adds a process time header to the HTTP response. It calculates the time taken to process the request and adds it to the response headers. The function also logs the request and response details in the database.
-
-    The function first retrieves the Authorization header from the request and extracts the user information if a Bearer token is present. It then creates a database session based on the user's tenant. If no user is found, a session with the default schema is created.
-
-    Next, the function extracts the request headers and origin from the request. If the origin is not available, it uses the host header. It also retrieves the client IP address from the request.
-
-    The function then processes the request details, including the request parameters and headers. It removes sensitive information from the headers and logs the request details in the database.
-
-    After processing the request details, the function checks the client IP address. If the IP address is not localhost or a test client and does not start with "172.", it queries the database for the IP location. If the IP is not found in the database, it retrieves the IP location using an external API and saves it in the database.
-
-    If the IP is blocked in the database, the function returns an HTTP 418 response with the "X-Big-Brother" header set to "I am watching you". Otherwise, it proceeds with the request handling.
-
-    The function measures the time taken to process the request and adds it to the response headers. It also applies secure headers to the response.
-
-    Finally, the function logs the response details in the database and returns the response object.
-    """  # noqa: E501
-    # print("Request middleware...")
-
-    if "/static/" in request.url.path:
-        response: Response = await call_next(request)
-        return response
-
-    accept = request.headers.get("accept")
-
-    auth = str(request.headers.get("Authorization"))
-
-    if not request.cookies.get(cookie_name):
-        auth = ""
-        for h in request.headers.__dict__["_list"]:
-            # print(h)
-            if h[0].decode("ASCII") == "authorization":
-                request.headers.__dict__["_list"].remove(h)
-
-    if "*/*" in accept:
-        hxrequest = request.headers.get("hx-request")
-        if hxrequest and "true" == hxrequest:
-            zcookie = request.cookies.get(cookie_name)
-            auth = ""
-            if zcookie:
-                auth = "Bearer " + zcookie
-
-    user = ""
-    if "Bearer" in auth:
-        token = auth.split(" ")[1]
-        if token:
-            try:
-                user = get_current_user(token)
-            except Exception:
-                user = ""
-                pass
-
-    print(user)
-
-    hdr = str(request.headers).replace("Headers(", "")
-    hdr = hdr[: len(hdr) - 1]
-    origin = request.headers.get("origin")
-    if not origin and request.headers.get("host"):
-        origin = request.headers.get("host")
-
-    try:
-        clientIp = request.client.host
-    except Exception:
-        clientIp = request.headers["host"]  # request.client.host
-
-    start_time = time.time()
-    response: Response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    reqstr = f" --> request>> url.path:{request.url.path}"
-    reqstr += f", method:{request.method}"
-    reqstr += f", client.host:{clientIp}"
-    reqstr += f", origin:{origin}"
-    reqstr += f", clientIp:{clientIp}"
-
-    # print("Response middleware")
-    return response
+def set_refresh_cookie(response: Response, refresh_token: str):
+    # only ever sent to the /token endpoints
+    response.set_cookie(
+        key=refresh_cookie_name,
+        value=f"{refresh_token}",
+        max_age=settings.JWT_REFRESH_TOKEN_EXPIRE_MINUTES * 60,
+        expires=settings.JWT_REFRESH_TOKEN_EXPIRE_MINUTES * 60,
+        path="/token",
+        secure=False,
+        samesite="strict",
+        httponly=True,
+    )
 
 
 @app.exception_handler(404)
@@ -228,6 +201,42 @@ def test2(request: Request):
     return f"{user}"
 
 
+@app.get("/health", include_in_schema=False)
+def health():
+    return {"status": "ok"}
+
+
+@app.get("/.well-known/jwks.json", include_in_schema=False)
+def jwks():
+    """Public keys for verifying our access tokens (empty with HS* signing)"""
+    return JSONResponse(
+        get_key_set().jwks, headers={"Cache-Control": "public, max-age=300"}
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics(request: Request):
+    """Internal numbers (login failures, latencies, routes): needs the
+    METRICS_TOKEN bearer token, or DEV_MODE when no token is configured"""
+    if not settings.METRICS_TOKEN:
+        if not settings.DEV_MODE:
+            # a plain 404, the 404 handler would redirect to /admin
+            return PlainTextResponse("Not Found", status_code=404)
+    elif not hmac.compare_digest(
+        request.headers.get("authorization", "").encode(),
+        f"Bearer {settings.METRICS_TOKEN}".encode(),
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not Authorized",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get(
     "/favicon.ico", include_in_schema=False
 )  # Prevent 404 for browser trying to get favico
@@ -255,8 +264,7 @@ def default(request: Request):
 @app.get("/login", response_class=HTMLResponse, include_in_schema=False)
 def getlogin(request: Request, session: Session = Depends(get_session)):
 
-    stmnt = select(User, Role).join(Role, isouter=True)
-    users: list[User] | None = session.exec(statement=stmnt).all()
+    initialized = is_initialized(session)
 
     message = (
         ""
@@ -264,7 +272,7 @@ def getlogin(request: Request, session: Session = Depends(get_session)):
         else request.query_params.get("message")
     )
 
-    if len(users) == 0:
+    if not initialized:
         return RedirectResponse("/user/create")
 
     if request.cookies.get(cookie_name) is None:
@@ -278,26 +286,40 @@ def getlogin(request: Request, session: Session = Depends(get_session)):
 
 
 @app.post("/login")
-def login(
+async def login(
     request: Request,
     response: Response,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
 
     accept = request.headers.get("accept")
 
+    # throttled before the user lookup and any bcrypt work
+    wait = await get_login_limiter().hit(
+        ip=request.client.host if request.client else "unknown",
+        user=form_data.username.strip().lower(),
+    )
+    if wait:
+        login_attempts.inc(result="throttled")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
     stmnt = (
         select(User, Role)
         .join(Role, isouter=True)
-        .where(User.email == form_data.username)
+        .where(User.email == form_data.username, User.deleted == 0)
     )
-    userdata: User | None = session.exec(statement=stmnt).all()
+    userdata: User | None = (await session.exec(statement=stmnt)).all()
 
     if len(userdata) > 0:
         userdata = userdata[0]
 
     if len(userdata) == 0:
+        login_attempts.inc(result="failure")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -307,7 +329,8 @@ def login(
     role = userdata.Role
 
     hashed_pass = user.hashed_password
-    if not verify_password(form_data.password, hashed_pass):
+    if not await verify_password_async(form_data.password, hashed_pass):
+        login_attempts.inc(result="failure")
         if "json" in accept:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -319,18 +342,23 @@ def login(
                 detail="Incorrect email or password",
             )
 
-    data = {
-        "sub": str(user.id),
-        "user_name": user.email,
-        "organization": "",
-        "orgid": 0,
-        "role": role.name,
-        "accepted_tc": None,
-        "impersonated": False,
-        "impersonated_by": None,
-    }
+    login_attempts.inc(result="success")
+
+    # upgrade (or downgrade) the stored hash to the configured bcrypt cost
+    if needs_rehash(hashed_pass):
+        try:
+            user.hashed_password = await hash_password_async(form_data.password)
+            session.add(user)
+            await bump_version_async(session, "user")
+            await session.commit()
+        except Exception as ex:
+            await session.rollback()
+            logger.warning("login rehash failed: %s", ex)
+
+    data = principal_claims(user.id, user.email, role.name)
 
     access_token = create_access_token(data)
+    refresh_token = create_refresh_token(data)
 
     if "json" not in accept:
         if access_token:  # request.cookies.get(cookie_name):
@@ -350,6 +378,7 @@ def login(
                     samesite="strict",
                     httponly=True,
                 )
+                set_refresh_cookie(response, refresh_token)
                 return response
 
     response.set_cookie(
@@ -361,16 +390,142 @@ def login(
         samesite="strict",
         httponly=True,
     )
+    set_refresh_cookie(response, refresh_token)
+
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
+
+
+@app.post("/token/refresh")
+async def token_refresh(
+    request: Request,
+    response: Response,
+    body: RefreshRequest | None = None,
+    session: AsyncSession = Depends(get_async_session),
+):
+    """Swaps a refresh token (from the body or the refresh cookie) for a new
+    access and refresh token pair, no password check needed. Every refresh
+    token is single use, presenting one twice revokes its whole family"""
+
+    token = (body.refresh_token if body else None) or request.cookies.get(
+        refresh_cookie_name
+    )
+    if not token:
+        token_refreshes.inc(result="failure")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+        )
+
+    try:
+        payload = decode_refresh_token(token)
+    except HTTPException:
+        token_refreshes.inc(result="failure")
+        raise
+
+    jti, family = payload["jti"], payload["fam"]
+
+    # the insert is what consumes the token, losing a race counts as a replay
+    revoked = await is_revoked_async(session, jti, family_key(family))
+    if revoked or not await revoke_async(session, jti, payload["exp"]):
+        # replay of a rotated (or logged out) token, one of the holders is not
+        # the owner so the whole chain ends here
+        await revoke_async(session, family_key(family), family_expires())
+        token_refreshes.inc(result="revoked")
+        logger.warning("revoked refresh token presented, family %s", family)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Refresh token revoked",
+        )
+
+    # one primary key lookup, picks up role changes and deleted users
+    stmnt = (
+        select(User.id, User.email, Role.name)
+        .join(Role, isouter=True)
+        .where(User.id == int(payload["sub"]), User.deleted == 0)
+    )
+    principal = (await session.exec(statement=stmnt)).first()
+
+    if principal is None:
+        token_refreshes.inc(result="failure")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+        )
+
+    data = principal_claims(principal.id, principal.email, principal.name)
+
+    access_token = create_access_token(data)
+    refresh_token = create_refresh_token(data, family=family)
+
+    response.set_cookie(
+        key=cookie_name,
+        value=f"{access_token}",
+        max_age=settings.JWT_EXPIRE * 60,
+        expires=settings.JWT_EXPIRE * 60,
+        secure=False,
+        samesite="strict",
+        httponly=True,
+    )
+    set_refresh_cookie(response, refresh_token)
+    token_refreshes.inc(result="success")
 
     return {
         "access_token": access_token,
         "token_type": "bearer",
-        "refresh_token": create_refresh_token(data),
+        "refresh_token": refresh_token,
     }
 
 
+@app.post("/token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+async def token_revoke(
+    request: Request,
+    body: RefreshRequest | None = None,
+    session: AsyncSession = Depends(get_async_session),
+):
+    """Revokes the refresh token and every token rotated from it"""
+
+    token = (body.refresh_token if body else None) or request.cookies.get(
+        refresh_cookie_name
+    )
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+        )
+
+    payload = decode_refresh_token(token)
+    await revoke_async(session, family_key(payload["fam"]), family_expires())
+
+    response = Response(status_code=status.HTTP_204_NO_CONTENT)
+    response.delete_cookie(key=refresh_cookie_name, path="/token")
+    return response
+
+
 @app.get("/logout", response_class=HTMLResponse, include_in_schema=False)
-def logout(request: Request):
+def logout():
+    # the refresh cookie is only sent to /token, it is revoked there
+    return RedirectResponse(url="/token/logout", status_code=303)
+
+
+@app.get("/token/logout", response_class=HTMLResponse, include_in_schema=False)
+async def token_logout(
+    request: Request, session: AsyncSession = Depends(get_async_session)
+):
+    """Revokes the refresh token family of the session and clears the cookies,
+    a copy of the refresh token can not mint access tokens after logout"""
+    token = request.cookies.get(refresh_cookie_name)
+    if token:
+        try:
+            payload = decode_refresh_token(token)
+        except HTTPException:
+            payload = None
+        if payload is not None:
+            await revoke_async(session, family_key(payload["fam"]), family_expires())
+
     message = ""
     response = RedirectResponse(
         url="/admin", status_code=303, headers={"X-Logout-Message": message}
@@ -384,4 +539,5 @@ def logout(request: Request):
         samesite="strict",
         httponly=True,
     )
+    response.delete_cookie(key=refresh_cookie_name, path="/token")
     return response
@@ -0,0 +1,248 @@
+"""Small in-process metrics registry with Prometheus text exposition
+
+Every worker keeps its own counters and histograms. When METRICS_DIR is set
+each worker also writes a snapshot of its values to
+`METRICS_DIR/metrics_<pid>.json` every METRICS_FLUSH_INTERVAL seconds, and
+/metrics sums the snapshots of all workers (past and present, counters are
+cumulative). Clear the directory when the server starts.
+"""
+
+from bisect import bisect_left
+import glob
+import json
+import math
+import os
+from threading import Event, Lock, Thread
+
+from settings import get_settings
+
+settings = get_settings()
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+)
+
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, list] = {}
+        self._lock = Lock()
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = [[list(key), list(value)] for key, value in self._values.items()]
+        return {
+            "type": self.type,
+            "help": self.help,
+            "labelnames": list(self.labelnames),
+            "samples": samples,
+        }
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                self._values[key] = [amount]
+            else:
+                value[0] += amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(buckets) + (math.inf,)
+        super().__init__(name, help, labelnames)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            # per bucket counts (not cumulative), then sum and count
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def snapshot(self) -> dict:
+        data = super().snapshot()
+        data["buckets"] = [str(bucket) for bucket in self.buckets]
+        return data
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self._flusher: Thread | None = None
+        self._stop = Event()
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def snapshot_path(self) -> str:
+        return os.path.join(settings.METRICS_DIR, f"metrics_{os.getpid()}.json")
+
+    def flush(self):
+        """Write this worker's snapshot to METRICS_DIR (atomically)"""
+        if not settings.METRICS_DIR:
+            return
+        path = self.snapshot_path()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(self.snapshot(), fp)
+        os.replace(tmp_path, path)
+
+    def collect(self) -> dict:
+        """Snapshot of all workers when METRICS_DIR is set, else of this one"""
+        if not settings.METRICS_DIR:
+            return self.snapshot()
+
+        self.flush()
+        merged: dict = {}
+        for path in glob.glob(os.path.join(settings.METRICS_DIR, "metrics_*.json")):
+            try:
+                with open(path) as fp:
+                    snapshot = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            for name, data in snapshot.items():
+                target = merged.setdefault(name, {**data, "samples": {}})
+                for key, values in data["samples"]:
+                    key = tuple(key)
+                    current = target["samples"].get(key)
+                    if current is None:
+                        target["samples"][key] = list(values)
+                    else:
+                        for i, value in enumerate(values):
+                            current[i] += value
+        for data in merged.values():
+            data["samples"] = [[list(k), v] for k, v in data["samples"].items()]
+        return merged
+
+    def start_flusher(self):
+        if not settings.METRICS_DIR or self._flusher is not None:
+            return
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        self._stop.clear()
+        self._flusher = Thread(target=self._flush_loop, name="metrics", daemon=True)
+        self._flusher.start()
+
+    def stop_flusher(self):
+        if self._flusher is None:
+            return
+        self._stop.set()
+        self._flusher.join()
+        self._flusher = None
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stop.wait(settings.METRICS_FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+
+registry = Registry()
+
+
+def _labels(labelnames, key) -> str:
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_metrics() -> str:
+    """Prometheus text format (version 0.0.4)"""
+    lines = []
+    for name, data in sorted(registry.collect().items()):
+        lines.append(f"# HELP {name} {data['help']}")
+        lines.append(f"# TYPE {name} {data['type']}")
+        labelnames = data["labelnames"]
+        for key, values in data["samples"]:
+            if data["type"] == "histogram":
+                cumulative = 0
+                for bucket, count in zip(data["buckets"], values):
+                    cumulative += count
+                    le = "+Inf" if bucket == "inf" else bucket
+                    labels = _labels([*labelnames, "le"], [*key, le])
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                labels = _labels(labelnames, key)
+                lines.append(f"{name}_sum{labels} {values[-2]}")
+                lines.append(f"{name}_count{labels} {values[-1]}")
+            else:
+                lines.append(f"{name}{_labels(labelnames, key)} {values[0]}")
+    return "\n".join(lines) + "\n"
+
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests", ("method", "route", "status")
+)
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route")
+)
+db_query_seconds = Histogram(
+    "db_query_duration_seconds", "SQL statement execution time", buckets=DB_BUCKETS
+)
+db_pool_wait_seconds = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    ("engine",),
+    buckets=DB_BUCKETS,
+)
+login_attempts = Counter("login_attempts_total", "Login attempts", ("result",))
+token_refreshes = Counter(
+    "token_refreshes_total", "Refresh token rotations", ("result",)
+)
+password_seconds = Histogram(
+    "password_hash_duration_seconds",
+    "bcrypt hash/verify time, including the wait for the password pool",
+    ("operation",),
+)
@@ -1,6 +1,5 @@
 from datetime import datetime
-import enum
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_validator
 from sqlmodel import (
     Column,
     DateTime,
@@ -8,11 +7,8 @@ from sqlmodel import (
     Index,
     Relationship,
     SQLModel,
-    Session,
     func,
-    text,
 )
-from database import engine
 
 
 class TokenData(BaseModel):
@@ -26,12 +22,45 @@ class TokenData(BaseModel):
     impersonated_by: str | None = None
 
 
+class RefreshRequest(BaseModel):
+    refresh_token: str | None = None
+
+
 class Role(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str = Field(index=True, unique=True)
     user: list["User"] = Relationship(back_populates="role")
 
 
+class RoleShow(SQLModel):
+    id: int
+    name: str
+
+
+class TableVersion(SQLModel, table=True):
+    """Per table change counter, bumped in the same transaction as the change
+    so every worker can tell its cached copy is stale"""
+
+    name: str = Field(primary_key=True)
+    version: int = Field(default=0)
+
+
+class RevokedToken(SQLModel, table=True):
+    """Denylist of used refresh tokens (by jti) and revoked token families
+    ("fam:<id>"), rows are kept until the token would have expired anyway"""
+
+    key: str = Field(primary_key=True)
+    expires: int = Field(index=True)
+
+
+class RateLimitBucket(SQLModel, table=True):
+    """Token bucket state for ratelimit.SqliteBackend"""
+
+    key: str = Field(primary_key=True)
+    tokens: float
+    updated: float
+
+
 class User(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str = Field(index=True)
@@ -63,7 +92,10 @@ class User(SQLModel, table=True):
         ),
     )
 
-    __table_args__ = (Index("index_user", "email", unique=True),)
+    __table_args__ = (
+        Index("index_user", "email", unique=True),
+        Index("index_user_created_on", "created_on", "id"),
+    )
 
 
 class UserShow(SQLModel):
@@ -76,6 +108,11 @@ class UserShow(SQLModel):
     created_on: datetime
 
 
+class UserPage(BaseModel):
+    items: list[UserShow]
+    next: str | None = None
+
+
 class UserUpdate(SQLModel):
     name: str
     email: str
@@ -87,29 +124,57 @@ class UserCreate(UserUpdate):
     rpassword: str
 
 
-with Session(engine) as session:
-    names = []
-    try:
-        sql_role_types = """SELECT name, id FROM role ORDER BY id"""
-        role_types = session.exec(text(sql_role_types)).fetchall()
-        if len(role_types) == 0:
-            newRole = Role(name="Superuser")
-            session.add(newRole)
-            session.commit()
-            role_types = session.exec(text(sql_role_types)).fetchall()
-        for utype in role_types:
-            names.append(tuple(utype))
-    except Exception:
-        try:
-            SQLModel.metadata.tables["role"].create(engine)
-            newRole = Role(name="Superuser")
-            session.add(newRole)
-            session.commit()
-            role_types = session.exec(text(sql_role_types)).fetchall()
-            for utype in role_types:
-                names.append(tuple(utype))
-        except Exception:
-            pass
-        pass
-
-    RoleTypes = enum.Enum("RoleTypes", names)
+class UserSelection(BaseModel):
+    """Users picked by id and/or by filter, the conditions are combined"""
+
+    ids: list[int] | None = Field(default=None, max_length=10000)
+    role_id: int | None = None
+    enabled: bool | None = None
+    email_domain: str | None = None
+
+    @field_validator("email_domain")
+    @classmethod
+    def normalize_domain(cls, domain: str | None) -> str | None:
+        domain = (domain or "").strip().lstrip("@").lower()
+        return domain or None
+
+    def is_empty(self) -> bool:
+        return (
+            not self.ids
+            and self.role_id is None
+            and self.enabled is None
+            and not self.email_domain
+        )
+
+
+class UserBulkChanges(BaseModel):
+    """Columns a bulk update may set. `enabled` is not one of them: it is not
+    checked at login, so setting it would not take anyone's access away (bulk
+    delete does)"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    role_id: int | None = None
+
+
+class UserBulkUpdate(BaseModel):
+    where: UserSelection
+    set: UserBulkChanges
+
+
+class UserImport(BaseModel):
+    """One row of a bulk import"""
+
+    name: str = Field(min_length=1)
+    email: str
+    password: str = Field(min_length=1)
+    role_id: int
+    enabled: bool = False
+
+    @field_validator("email")
+    @classmethod
+    def normalize_email(cls, email: str) -> str:
+        email = email.strip()
+        if "@" not in email.strip("@"):
+            raise ValueError("Not a valid email address")
+        return email
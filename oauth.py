@@ -2,19 +2,51 @@ from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta, timezone
 from typing import Annotated, Optional
+import uuid
 import jwt
 from sqlmodel import Session, select
 
+from cache import TTLCache
+from logger import get_logger
 from models.base import TokenData, User
 from settings import get_settings
+from timing import timed
 from database import engine
+from keys import get_key_set, refresh_algorithm
 
 settings = get_settings()
 
 cookie_name = settings.COOKIE_NAME
 
+logger = get_logger(__name__)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
+# user id (token "sub") -> email of the live user, or None if deleted/missing
+principal_cache = TTLCache(
+    maxsize=settings.PRINCIPAL_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL
+)
+
+
+def invalidate_principal(user_id: int | None = None):
+    """Drop a cached principal (or all of them) after the user row changes"""
+    if user_id is None:
+        principal_cache.clear()
+    else:
+        principal_cache.pop(str(user_id))
+
+
+def lookup_principal(user_id: str, user_name: str) -> bool:
+    """Check the token owner still exists, hitting the DB only on cache miss"""
+    email = principal_cache.get(user_id, False)
+    if email is False:
+        with Session(engine) as session:
+            stmnt = select(User.email).where(User.id == int(user_id), User.deleted == 0)
+            email = session.exec(stmnt).first()
+        principal_cache.set(user_id, email)
+
+    return email is not None and email == user_name
+
 
 def create_access_token(data: dict, expires_delta: Optional[int] = None) -> str:
 
@@ -30,11 +62,32 @@ def create_access_token(data: dict, expires_delta: Optional[int] = None) -> str:
     to_encode.update({"exp": expires_delta})
     to_encode.update({"iss": "sample.com"})
     to_encode.update({"aud": "sample.com"})
-    encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET, settings.JWT_ALGO)
+    key_set = get_key_set()
+    encoded_jwt = jwt.encode(
+        to_encode, key_set.signing_key, key_set.algorithm, headers=key_set.headers
+    )
     return encoded_jwt
 
 
-def create_refresh_token(data: dict, expires_delta: Optional[int] = None) -> str:
+def principal_claims(user_id: int, user_name: str, role_name: str) -> dict:
+    """Token claims for a principal, shared by login and token refresh"""
+    return {
+        "sub": str(user_id),
+        "user_name": user_name,
+        "organization": "",
+        "orgid": 0,
+        "role": role_name,
+        "accepted_tc": None,
+        "impersonated": False,
+        "impersonated_by": None,
+    }
+
+
+def create_refresh_token(
+    data: dict, expires_delta: Optional[int] = None, family: str | None = None
+) -> str:
+    """Single use refresh token, `jti` identifies the token and `fam` the chain
+    of rotations it belongs to (a new family per login)"""
 
     if expires_delta is not None:
         expires_delta = datetime.now(tz=timezone.utc) + expires_delta
@@ -48,19 +101,42 @@ def create_refresh_token(data: dict, expires_delta: Optional[int] = None) -> str
     to_encode.update({"exp": expires_delta})
     to_encode.update({"iss": "sample.com"})
     to_encode.update({"aud": "sample.com"})
+    to_encode.update({"jti": uuid.uuid4().hex})
+    to_encode.update({"fam": family or uuid.uuid4().hex})
     encoded_jwt = jwt.encode(
-        to_encode, settings.JWT_REFRESH_SECRET_KEY, settings.JWT_ALGO
+        to_encode, settings.JWT_REFRESH_SECRET_KEY, refresh_algorithm
     )
     return encoded_jwt
 
 
+def decode_refresh_token(token: str) -> dict:
+    """Verify a refresh token signature and claims, returns the payload.
+    Whether it was already used is checked against repository.revocation"""
+    try:
+        with timed("auth"):
+            return jwt.decode(
+                token,
+                settings.JWT_REFRESH_SECRET_KEY,
+                algorithms=[refresh_algorithm],
+                audience="sample.com",
+                options={"require": ["exp", "sub", "jti", "fam"]},
+            )
+    except Exception as ex:
+        logger.debug("invalid refresh token: %s", ex)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+        )
+
+
 def validate_access_token(token: str):
     """Convenience function just to validate a JWT token\nReturn Frue or False"""
     try:
+        key_set = get_key_set()
         payload = jwt.decode(
             token,
-            settings.JWT_SECRET,
-            algorithms=[settings.JWT_ALGO],
+            key_set.verification_key(token),
+            algorithms=[key_set.algorithm],
             audience="sample.com",
         )
         user_id = payload.get("sub")
@@ -68,7 +144,7 @@ def validate_access_token(token: str):
             return False
 
     except Exception as ex:
-        print(ex)
+        logger.debug("invalid access token: %s", ex)
         return False
 
     return True
@@ -77,10 +153,11 @@ def validate_access_token(token: str):
 def verify_access_token(token: str, credentials_exception, credentials_expired):
     """Verify a JWT token for endpoints"""
     try:
+        key_set = get_key_set()
         payload = jwt.decode(
             token,
-            settings.JWT_SECRET,
-            algorithms=[settings.JWT_ALGO],
+            key_set.verification_key(token),
+            algorithms=[key_set.algorithm],
             audience="sample.com",
         )
 
@@ -107,12 +184,9 @@ def verify_access_token(token: str, credentials_exception, credentials_expired):
             impersonated=impersonated,
             impersonated_by=impersonated_by,
         )
-        with Session(engine) as session:
-            stmnt = select(User).where(User.email == user_name)
-            user = session.exec(stmnt).first()
-
-        if user is None:
-            token_data = None
+        # deleted (or renamed) users lose access before their token expires
+        if not lookup_principal(str(user_id), user_name):
+            raise credentials_exception
     except Exception as JWTError:
 
         if JWTError.args:
@@ -127,8 +201,29 @@ def verify_access_token(token: str, credentials_exception, credentials_expired):
     return token_data
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> TokenData:
-    """Returns current user from JWT"""
+def set_request_principal(request: Request, token: str, user: TokenData):
+    """Remember the principal resolved for `token` on this request"""
+    request.state.principal = (token, user)
+
+
+def get_request_principal(request: Request, token: str) -> TokenData | None:
+    """Principal already resolved for `token` on this request, if any"""
+    principal = getattr(request.state, "principal", None)
+    if principal is not None and principal[0] == token:
+        return principal[1]
+    return None
+
+
+def get_current_user(
+    token: Annotated[str, Depends(oauth2_scheme)], request: Request = None
+) -> TokenData:
+    """Returns current user from JWT\nReuses the principal resolved by the
+    middleware when the request carries the same token"""
+    if request is not None:
+        user = get_request_principal(request, token)
+        if user is not None:
+            return user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_403_FORBIDDEN,
         detail="Could not validate credentials",
@@ -139,13 +234,17 @@ def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> TokenData
         detail="Credentials have expired",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    return verify_access_token(token, credentials_exception, credentials_expired)
+    with timed("auth"):
+        user = verify_access_token(token, credentials_exception, credentials_expired)
+    if request is not None:
+        set_request_principal(request, token, user)
+    return user
 
 
 async def get_current_user_from_cookie(request: Request):
     if request.cookies.get(cookie_name):
         cookie = request.cookies.get(cookie_name)
-        return get_current_user(cookie)
+        return get_current_user(cookie, request)
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not authenticated"
     )
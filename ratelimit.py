@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+import time
+
+from sqlalchemy import text
+
+from database import async_engine
+from settings import get_settings
+
+settings = get_settings()
+
+
+# Token buckets: `capacity` attempts at once, refilled at `rate` per second
+# (capacity / window), so the limit slides with time instead of resetting at
+# fixed window edges. Rejected attempts still cost a token (down to -1), so a
+# client that keeps hammering stays locked out.
+
+
+def take_token(tokens: float, elapsed: float, capacity: float, rate: float) -> float:
+    """Bucket level after one attempt, the attempt is allowed if it is >= 0"""
+    return max(-1.0, min(capacity, tokens + elapsed * rate) - 1)
+
+
+def retry_after(tokens: float, rate: float) -> float:
+    """Seconds until the next attempt would be allowed"""
+    return max(0.0, (1 - tokens) / rate)
+
+
+class MemoryBackend:
+    """Buckets in a bounded LRU dict, per process"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = Lock()
+
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = take_token(tokens, now - updated, capacity, rate)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return tokens
+
+    async def purge(self, max_age: float):
+        pass
+
+
+class SqliteBackend:
+    """Buckets in the ratelimitbucket table, shared by every worker. One
+    upsert per attempt, the refill is computed inside the statement so
+    concurrent workers can not lose updates"""
+
+    take_statement = text(
+        "INSERT INTO ratelimitbucket (key, tokens, updated) "
+        "VALUES (:key, :capacity - 1, :now) "
+        "ON CONFLICT (key) DO UPDATE SET "
+        "tokens = max(-1.0, min(:capacity, tokens + (:now - updated) * :rate) - 1), "
+        "updated = :now "
+        "RETURNING tokens"
+    )
+
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(
+                self.take_statement,
+                {"key": key, "capacity": capacity, "rate": rate, "now": time.time()},
+            )
+            return result.scalar_one()
+
+    async def purge(self, max_age: float):
+        """Drop buckets that have refilled completely anyway"""
+        async with async_engine.begin() as conn:
+            await conn.execute(
+                text("DELETE FROM ratelimitbucket WHERE updated < :cutoff"),
+                {"cutoff": time.time() - max_age},
+            )
+
+
+# RATE_LIMIT_BACKEND name -> backend factory
+backends = {
+    "memory": lambda: MemoryBackend(max_keys=settings.RATE_LIMIT_MAX_KEYS),
+    "sqlite": SqliteBackend,
+}
+
+
+class RateLimiter:
+    """Named limits (`limit` attempts per `window` seconds) on one backend"""
+
+    def __init__(self, backend, limits: dict[str, tuple[int, float]]):
+        self.backend = backend
+        self.limits = limits
+
+    async def hit(self, **keys: str) -> float:
+        """Takes a token from the bucket of every `name=key` pair, returns 0 if
+        the attempt is allowed or else the seconds the caller has to wait"""
+        wait = 0.0
+        for name, key in keys.items():
+            limit, window = self.limits[name]
+            rate = limit / window
+            tokens = await self.backend.take(f"{name}:{key}", limit, rate)
+            if tokens < 0:
+                wait = max(wait, retry_after(tokens, rate))
+        return wait
+
+    async def purge(self):
+        await self.backend.purge(max(window for _, window in self.limits.values()))
+
+
+@lru_cache()
+def get_login_limiter() -> RateLimiter:
+    return RateLimiter(
+        backends[settings.RATE_LIMIT_BACKEND](),
+        {
+            "ip": (settings.LOGIN_RATE_IP, settings.LOGIN_RATE_WINDOW),
+            "user": (settings.LOGIN_RATE_USER, settings.LOGIN_RATE_WINDOW),
+        },
+    )
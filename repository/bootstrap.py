@@ -0,0 +1,38 @@
+from sqlmodel import Session, select
+
+from database import AsyncSession
+from models.base import User
+
+# Once the first user exists the system stays initialized (users are only soft
+# deleted), so only the positive answer is cached
+_initialized = False
+
+
+def mark_initialized():
+    global _initialized
+    _initialized = True
+
+
+def is_initialized(session: Session) -> bool:
+    """True once at least one user exists"""
+    if _initialized:
+        return True
+
+    stmnt = select(User.id).limit(1)
+
+    if session.exec(statement=stmnt).first() is not None:
+        mark_initialized()
+
+    return _initialized
+
+
+async def is_initialized_async(session: AsyncSession) -> bool:
+    if _initialized:
+        return True
+
+    stmnt = select(User.id).limit(1)
+
+    if (await session.exec(statement=stmnt)).first() is not None:
+        mark_initialized()
+
+    return _initialized
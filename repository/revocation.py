@@ -0,0 +1,65 @@
+import time
+
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, delete, select
+
+from cache import TTLCache
+from database import AsyncSession
+from models.base import RevokedToken
+from settings import get_settings
+
+settings = get_settings()
+
+# denylist keys known to be revoked, entries never become valid again so
+# only positive results are cached
+revoked_cache = TTLCache(
+    maxsize=settings.REVOKED_CACHE_SIZE,
+    ttl=int(settings.JWT_REFRESH_TOKEN_EXPIRE_MINUTES) * 60,
+)
+
+
+def family_key(family: str) -> str:
+    return f"fam:{family}"
+
+
+def family_expires() -> int:
+    """A family lives as long as the newest refresh token it may still issue"""
+    return int(time.time()) + int(settings.JWT_REFRESH_TOKEN_EXPIRE_MINUTES) * 60
+
+
+def _revoke_statement(key: str, expires: int):
+    stmnt = insert(RevokedToken).values(key=key, expires=expires)
+    return stmnt.on_conflict_do_nothing(index_elements=[RevokedToken.key])
+
+
+def purge_revoked_tokens(session: Session) -> int:
+    """Drop denylist rows of tokens that have expired anyway"""
+    result = session.exec(
+        delete(RevokedToken).where(RevokedToken.expires < time.time())
+    )
+    session.commit()
+    return result.rowcount
+
+
+async def is_revoked_async(session: AsyncSession, *keys: str) -> bool:
+    if any(revoked_cache.get(key) for key in keys):
+        return True
+
+    stmnt = select(RevokedToken.key).where(RevokedToken.key.in_(keys))
+
+    revoked = (await session.exec(statement=stmnt)).all()
+
+    for key in revoked:
+        revoked_cache.set(key, True)
+
+    return len(revoked) > 0
+
+
+async def revoke_async(session: AsyncSession, key: str, expires: int) -> bool:
+    """Denylist `key` and commit, False if it already was (so a token can be
+    consumed only once, even with several workers racing)"""
+    result = await session.exec(_revoke_statement(key, expires))
+    await session.commit()
+    revoked_cache.set(key, True)
+
+    return result.rowcount == 1
@@ -1,14 +1,9 @@
 from sqlmodel import Session, select
 
+from database import AsyncSession
 from models.base import Role, TokenData
-
-
-def get_roles(session: Session):
-    stmnt = select(Role)
-
-    roles = session.exec(statement=stmnt).all()
-
-    return roles
+from repository.rolecatalog import role_catalog
+from repository.version import bump_version, bump_version_async
 
 
 def create_role(session: Session, rolename: str, adminuser: TokenData | None = None):
@@ -17,11 +12,15 @@ def create_role(session: Session, rolename: str, adminuser: TokenData | None = N
 
     try:
         session.add(newrole)
+        bump_version(session, "role")
         session.commit()
         session.refresh(newrole)
     except Exception as ex:
         session.rollback()
         raise ex
+    role_catalog.invalidate()
+
+    return newrole
 
 
 def delete_role(session: Session, roleid: int, adminuser: TokenData):
@@ -33,8 +32,58 @@ def delete_role(session: Session, roleid: int, adminuser: TokenData):
     role = session.exec(stmnt).first()
 
     if role:
+        try:
+            session.delete(role)
+            bump_version(session, "role")
+            session.commit()
+        except Exception as ex:
+            session.rollback()
+            raise ex
+        role_catalog.invalidate()
+        result = True
+
+    return result
+
+
+# Async variants, used with database.get_async_session
+
+
+async def create_role_async(
+    session: AsyncSession, rolename: str, adminuser: TokenData | None = None
+):
+
+    newrole = Role(name=rolename)
+
+    try:
+        session.add(newrole)
+        await bump_version_async(session, "role")
+        await session.commit()
+        await session.refresh(newrole)
+    except Exception as ex:
+        await session.rollback()
+        raise ex
+    role_catalog.invalidate()
+
+    return newrole
+
+
+async def delete_role_async(session: AsyncSession, roleid: int, adminuser: TokenData):
+
+    result = False
+
+    stmnt = select(Role).filter(Role.id == roleid)
+
+    role = (await session.exec(stmnt)).first()
+
+    if role:
+        try:
+            await session.delete(role)
+            await bump_version_async(session, "role")
+            await session.commit()
+        except Exception as ex:
+            await session.rollback()
+            raise ex
+        role_catalog.invalidate()
         result = True
-        session.delete(role)
-        session.commit()
 
     return result
@@ -0,0 +1,92 @@
+from threading import Lock
+import time
+
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from database import engine
+from models.base import Role, RoleShow
+from repository.version import get_version
+from settings import get_settings
+
+settings = get_settings()
+
+# the first two roles (by id) are the admin roles
+ADMIN_ROLE_COUNT = 2
+
+
+class RoleCatalog:
+    """In memory snapshot of the role table
+
+    Readers get the snapshot without touching the DB. At most every
+    `check_interval` seconds the "role" TableVersion counter is read and the
+    snapshot is reloaded if another worker changed the roles. Changes made by
+    this worker call `invalidate()` and are seen immediately.
+
+    The reload is a sync query, async callers use `refresh_async()` to run it
+    in the threadpool (the middleware does this before every auth route).
+    """
+
+    def __init__(self, check_interval: float = 5):
+        self.check_interval = check_interval
+        self._roles: tuple[RoleShow, ...] = ()
+        self._admin_roles: frozenset[str] = frozenset()
+        self._version = -1
+        self._checked = 0.0
+        self._lock = Lock()
+
+    def stale(self) -> bool:
+        """True when the next read would check the DB"""
+        return (
+            self._version < 0 or time.monotonic() - self._checked >= self.check_interval
+        )
+
+    def refresh(self):
+        if not self.stale():
+            return
+
+        with self._lock:
+            if not self.stale():
+                return
+            with Session(engine) as session:
+                version = get_version(session, "role")
+                if version != self._version:
+                    stmnt = select(Role).order_by(Role.id)
+                    roles = tuple(
+                        RoleShow(id=role.id, name=role.name)
+                        for role in session.exec(statement=stmnt).all()
+                    )
+                    self._roles = roles
+                    self._admin_roles = frozenset(
+                        role.name for role in roles[:ADMIN_ROLE_COUNT]
+                    )
+                    self._version = version
+            self._checked = time.monotonic()
+
+    async def refresh_async(self):
+        if self.stale():
+            await run_in_threadpool(self.refresh)
+
+    def roles(self) -> tuple[RoleShow, ...]:
+        self.refresh()
+        return self._roles
+
+    def version(self) -> int:
+        """Version of the current snapshot (the "role" TableVersion counter)"""
+        self.refresh()
+        return self._version
+
+    def admin_roles(self) -> frozenset[str]:
+        self.refresh()
+        return self._admin_roles
+
+    def is_admin(self, role_name: str) -> bool:
+        return role_name in self.admin_roles()
+
+    def invalidate(self):
+        """Force a reload on the next read"""
+        with self._lock:
+            self._version = -1
+
+
+role_catalog = RoleCatalog(check_interval=settings.ROLE_CATALOG_CHECK_INTERVAL)
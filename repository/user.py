@@ -1,92 +1,292 @@
 from datetime import datetime, timezone
+import base64
+import json
 from fastapi import HTTPException, status
-from sqlmodel import Session, select
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import String, insert, tuple_, type_coerce, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
+from sqlmodel import Session, func, select
 
-from models.base import Role, TokenData, User, UserCreate
-from utils import hash_password
+from database import AsyncSession
+from models.base import (
+    Role,
+    TokenData,
+    User,
+    UserCreate,
+    UserImport,
+    UserSelection,
+)
+from repository.bootstrap import is_initialized_async, mark_initialized
+from repository.rolecatalog import role_catalog
+from repository.version import bump_version, bump_version_async
+from oauth import invalidate_principal
+from settings import get_settings
+from utils import hash_password_async, hash_passwords_async
 
+settings = get_settings()
 
-def get_users(session: Session):
+USER_PAGE_ORDERS = ("id", "created_on")
+
+user_import_adapter = TypeAdapter(list[UserImport])
+
+
+def count_users(session: Session) -> int:
+    stmnt = select(func.count()).select_from(User).where(User.deleted == 0)
+
+    return session.exec(statement=stmnt).one()
+
+
+def encode_user_cursor(user: User, order_by: str = "id") -> str:
+    """Opaque keyset cursor pointing just after `user`"""
+    key = [order_by, user.id]
+    if order_by == "created_on":
+        key.append(user.created_on.strftime("%Y-%m-%d %H:%M:%S"))
+    raw = json.dumps(key, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_user_cursor(cursor: str, order_by: str = "id") -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key = json.loads(raw)
+        if key[0] != order_by or not isinstance(key[1], int):
+            raise ValueError
+        if order_by == "created_on" and not isinstance(key[2], str):
+            raise ValueError
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return key
+
+
+def page_limit(limit: int | None) -> int:
+    if not limit or limit < 1:
+        return settings.USER_PAGE_SIZE
+    return min(limit, settings.USER_PAGE_MAX)
+
+
+def users_page_statement(limit: int, cursor: str | None = None, order_by: str = "id"):
+    """Keyset paginated user list, fetches one extra row to detect a next page"""
+    if order_by not in USER_PAGE_ORDERS:
+        raise ValueError(f"Invalid order: {order_by}")
+
+    # populate User.role from the join so list views don't lazy load per row
     stmnt = (
-        select(User).join(Role, isouter=True).filter(User.deleted == 0)
-    )  # .where(text("deleted = 0"))
+        select(User)
+        .join(Role, isouter=True)
+        .options(contains_eager(User.role))
+        .filter(User.deleted == 0)
+    )
+
+    if order_by == "created_on":
+        if cursor:
+            _, last_id, last_created_on = decode_user_cursor(cursor, order_by)
+            # raw column against a row value (bound as the stored text) so
+            # SQLite seeks on index_user_created_on
+            stmnt = stmnt.filter(
+                tuple_(User.created_on, User.id)
+                > tuple_(type_coerce(last_created_on, String), last_id)
+            )
+        stmnt = stmnt.order_by(User.created_on, User.id)
+    else:
+        if cursor:
+            _, last_id = decode_user_cursor(cursor, order_by)
+            stmnt = stmnt.filter(User.id > last_id)
+        stmnt = stmnt.order_by(User.id)
+
+    return stmnt.limit(limit + 1)
+
+
+def split_users_page(users: list[User], limit: int, order_by: str):
+    users = list(users)
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_user_cursor(users[-1], order_by)
+    return users, next_cursor
+
+
+def get_users_page(
+    session: Session,
+    limit: int | None = None,
+    cursor: str | None = None,
+    order_by: str = "id",
+) -> tuple[list[User], str | None]:
+    """Returns one page of users and the cursor for the next page (or None)"""
+    limit = page_limit(limit)
+    stmnt = users_page_statement(limit, cursor, order_by)
 
     users = session.exec(statement=stmnt).all()
 
-    return users
+    return split_users_page(users, limit, order_by)
+
+
+def update_user(session: Session, user_id: int, upduser: User, adminuser: TokenData):
+    stmnt = select(User).join(Role, isouter=True).filter(User.id == user_id)
+
+    edituser = session.exec(statement=stmnt).first()
+
+    if (
+        edituser.name != upduser.name
+        or edituser.email != upduser.email
+        or edituser.role_id != upduser.role_id
+    ):
+        try:
+            edituser.name = upduser.name
+            edituser.email = upduser.email
+            edituser.role_id = upduser.role_id
+            edituser.modified_by = adminuser.sub
+            edituser.modified_on = datetime.now(tz=timezone.utc)
+            bump_version(session, "user")
+            session.commit()
+            session.refresh(edituser)
+        except Exception as ex:
+            session.rollback()
+            raise ex
+        invalidate_principal(user_id)
+
+    return edituser
+
+
+def delete_user(session: Session, userid: int, adminuser: TokenData):
+
+    stmnt = select(User).filter(User.id == userid)
+
+    user = session.exec(stmnt).first()
+
+    if not user:
+        raise Exception(f"User not found: id {userid}")
+
+    user.deleted = True
+    bump_version(session, "user")
+
+    session.commit()
+    session.refresh(user)
+    invalidate_principal(userid)
+
+    return
+
 
+# Async variants, used with database.get_async_session
 
-def create_user(
-    session: Session, newuser: UserCreate, adminuser: TokenData | None = None
+
+async def get_users_page_async(
+    session: AsyncSession,
+    limit: int | None = None,
+    cursor: str | None = None,
+    order_by: str = "id",
+) -> tuple[list[User], str | None]:
+    limit = page_limit(limit)
+    stmnt = users_page_statement(limit, cursor, order_by)
+
+    users = (await session.exec(statement=stmnt)).all()
+
+    return split_users_page(users, limit, order_by)
+
+
+async def stream_users_async(session: AsyncSession, batch_size: int | None = None):
+    """Yields batches of user rows (as mappings) from a server side cursor,
+    only `batch_size` rows are held in memory at a time"""
+    stmnt = (
+        select(
+            User.id,
+            User.name,
+            User.email,
+            User.enabled,
+            User.role_id,
+            Role.name.label("role"),
+            User.created_on,
+            User.created_by,
+        )
+        .join(Role, isouter=True)
+        .filter(User.deleted == 0)
+        .order_by(User.id)
+        .execution_options(yield_per=batch_size or settings.USER_EXPORT_BATCH)
+    )
+
+    result = await session.stream(stmnt)
+
+    async for partition in result.mappings().partitions():
+        yield partition
+
+
+async def create_user_async(
+    session: AsyncSession, newuser: UserCreate, adminuser: TokenData | None = None
 ):
 
     if newuser.password != newuser.rpassword:
         raise Exception("Passwords do not match!")
 
-    stmnt = select(User, Role).join(Role, isouter=True)
-    users: list[User] | None = session.exec(statement=stmnt).all()
+    initialized = await is_initialized_async(session)
 
-    if len(users) > 0 and adminuser is None:
+    if initialized and adminuser is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not authenticated",
         )
 
+    hashed_password = await hash_password_async(newuser.password)
+
     # case when system is initialized with new DB
-    if len(users) == 0:
-        stmnt = select(Role)
-        roles: list[Role] | None = session.exec(statement=stmnt).all()
+    if not initialized:
+        stmnt = select(Role).filter(Role.name == "Superuser")
+        suRole: Role | None = (await session.exec(statement=stmnt)).first()
 
-        if len(roles) == 0:
-            newRole = Role(name="Superuser")
-            session.add(newRole)
-            session.commit()
-            session.refresh(newRole)
-            suRole = newRole
-        else:
-            stmnt = select(Role).filter(Role.name == "Superuser")
-            suRole: Role | None = session.exec(statement=stmnt).first()
+        if suRole is None:
+            suRole = Role(name="Superuser")
+            session.add(suRole)
+            await bump_version_async(session, "role")
+            await session.commit()
+            await session.refresh(suRole)
+            role_catalog.invalidate()
 
         newUser = User(
             name=newuser.name,
             email=newuser.email,
-            hashed_password=hash_password(newuser.password),
-            role=suRole,
+            hashed_password=hashed_password,
+            role_id=suRole.id,
             enabled=True,
         )
         session.add(newUser)
-        session.commit()
-        session.refresh(newUser)
+        await bump_version_async(session, "user")
+        await session.commit()
+        await session.refresh(newUser)
         newUser.created_by = newUser.id
-        session.commit()
+        await session.commit()
+        await session.refresh(newUser, ["role"])
+        mark_initialized()
 
         return newUser
 
     # case there are already users in DB
-    role = session.exec(select(Role).filter(Role.id == newuser.role_id)).first()
-
     newUser = User(
-        role=role,
+        role_id=newuser.role_id,
         name=newuser.name,
         email=newuser.email,
-        hashed_password=hash_password(newuser.password),
+        hashed_password=hashed_password,
         created_by=adminuser.sub,
     )
     session.add(newUser)
 
     try:
-        session.commit()
-        session.refresh(newUser)
+        await bump_version_async(session, "user")
+        await session.commit()
+        await session.refresh(newUser, ["role"])
         return newUser
     except Exception as ex:
-        session.rollback()
+        await session.rollback()
         raise ex
 
 
-def update_user(session: Session, user_id: int, upduser: User, adminuser: TokenData):
-    stmnt = select(User).join(Role, isouter=True).filter(User.id == user_id)
+async def update_user_async(
+    session: AsyncSession, user_id: int, upduser: User, adminuser: TokenData
+):
+    stmnt = select(User).filter(User.id == user_id)
 
-    edituser = session.exec(statement=stmnt).first()
+    edituser = (await session.exec(statement=stmnt)).first()
+
+    if not edituser:
+        raise Exception(f"User not found: id {user_id}")
 
     if (
         edituser.name != upduser.name
@@ -99,27 +299,195 @@ def update_user(session: Session, user_id: int, upduser: User, adminuser: TokenD
             edituser.role_id = upduser.role_id
             edituser.modified_by = adminuser.sub
             edituser.modified_on = datetime.now(tz=timezone.utc)
-            session.commit()
-            session.refresh(edituser)
+            await bump_version_async(session, "user")
+            await session.commit()
+            await session.refresh(edituser)
         except Exception as ex:
-            session.rollback()
+            await session.rollback()
             raise ex
+        invalidate_principal(user_id)
 
     return edituser
 
 
-def delete_user(session: Session, userid: int, adminuser: TokenData):
+async def delete_user_async(session: AsyncSession, userid: int, adminuser: TokenData):
 
     stmnt = select(User).filter(User.id == userid)
 
-    user = session.exec(stmnt).first()
+    user = (await session.exec(stmnt)).first()
 
     if not user:
         raise Exception(f"User not found: id {userid}")
 
     user.deleted = True
+    await bump_version_async(session, "user")
 
-    session.commit()
-    session.refresh(user)
+    await session.commit()
+    invalidate_principal(userid)
 
     return
+
+
+def _validation_message(errors: list[dict]) -> str:
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in error['loc'][1:])}: {error['msg']}"
+        for error in errors
+    )
+
+
+def validate_user_import(rows: list[dict], offset: int = 0):
+    """Validates a batch of rows in one pass, returns the valid rows (with
+    their row number) and an error entry for every invalid one"""
+    try:
+        users = user_import_adapter.validate_python(rows)
+        return list(enumerate(users, offset + 1)), []
+    except ValidationError as ex:
+        failed: dict[int, list[dict]] = {}
+        for error in ex.errors():
+            failed.setdefault(error["loc"][0], []).append(error)
+
+    errors = [
+        {"row": offset + index + 1, "error": _validation_message(failed[index])}
+        for index in sorted(failed)
+    ]
+    valid = [index for index in range(len(rows)) if index not in failed]
+    users = user_import_adapter.validate_python([rows[index] for index in valid])
+
+    return [(offset + index + 1, user) for index, user in zip(valid, users)], errors
+
+
+async def import_users_async(
+    session: AsyncSession, rows: list[dict], adminuser: TokenData
+) -> tuple[int, list[dict]]:
+    """Bulk create users, returns the number created and the per row errors.
+
+    Rows are validated and inserted in batches of USER_IMPORT_BATCH. Each
+    batch is hashed on the import process pool and written with a single
+    executemany in its own transaction."""
+    batch_size = settings.USER_IMPORT_BATCH
+    role_ids = {role.id for role in role_catalog.roles()}
+    seen: set[str] = set()
+    created = 0
+    errors: list[dict] = []
+
+    for offset in range(0, len(rows), batch_size):
+        users, batch_errors = validate_user_import(
+            rows[offset : offset + batch_size], offset
+        )
+        errors.extend(batch_errors)
+
+        stmnt = select(User.email).where(User.email.in_([u.email for _, u in users]))
+        existing = set((await session.exec(statement=stmnt)).all())
+
+        accepted = []
+        for row, user in users:
+            if user.role_id not in role_ids:
+                errors.append({"row": row, "error": f"Unknown role_id {user.role_id}"})
+            elif user.email in existing or user.email in seen:
+                errors.append({"row": row, "error": f"Email exists: {user.email}"})
+            else:
+                seen.add(user.email)
+                accepted.append((row, user))
+
+        if not accepted:
+            continue
+
+        hashed = await hash_passwords_async([user.password for _, user in accepted])
+        values = [
+            {
+                "name": user.name,
+                "email": user.email,
+                "hashed_password": hashed_password,
+                "role_id": user.role_id,
+                "enabled": user.enabled,
+                "created_by": adminuser.sub,
+            }
+            for (_, user), hashed_password in zip(accepted, hashed)
+        ]
+
+        try:
+            await session.exec(insert(User), params=values)
+            await bump_version_async(session, "user")
+            await session.commit()
+            created += len(values)
+        except IntegrityError:
+            # lost a race on an email, redo the batch row by row to find it
+            await session.rollback()
+            for (row, user), value in zip(accepted, values):
+                try:
+                    await session.exec(insert(User), params=[value])
+                    await bump_version_async(session, "user")
+                    await session.commit()
+                    created += 1
+                except IntegrityError:
+                    await session.rollback()
+                    errors.append({"row": row, "error": f"Email exists: {user.email}"})
+
+    errors.sort(key=lambda error: error["row"])
+
+    return created, errors
+
+
+def _selection_conditions(selection: UserSelection) -> list:
+    conditions = [User.deleted == 0]
+    if selection.ids:
+        conditions.append(User.id.in_(selection.ids))
+    if selection.role_id is not None:
+        conditions.append(User.role_id == selection.role_id)
+    if selection.enabled is not None:
+        conditions.append(User.enabled == selection.enabled)
+    if selection.email_domain:
+        # autoescape: % and _ in the domain match literally
+        conditions.append(
+            func.lower(User.email).endswith(
+                f"@{selection.email_domain}", autoescape=True
+            )
+        )
+    return conditions
+
+
+async def bulk_update_users_async(
+    session: AsyncSession,
+    selection: UserSelection,
+    values: dict,
+    adminuser: TokenData,
+) -> int:
+    """One set based UPDATE of every selected user, returns the row count.
+    The acting admin is never deleted through a bulk change"""
+    if selection.is_empty():
+        raise ValueError("Select users by ids or by a filter")
+    if not values:
+        raise ValueError("Nothing to change")
+    if "role_id" in values and values["role_id"] not in {
+        role.id for role in role_catalog.roles()
+    }:
+        raise ValueError(f"Unknown role_id {values['role_id']}")
+
+    conditions = _selection_conditions(selection)
+    if values.get("deleted"):
+        conditions.append(User.id != adminuser.sub)
+
+    stmnt = (
+        update(User)
+        .where(*conditions)
+        .values(
+            **values,
+            modified_by=adminuser.sub,
+            modified_on=datetime.now(tz=timezone.utc),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    try:
+        result = await session.exec(stmnt)
+        if result.rowcount:
+            await bump_version_async(session, "user")
+        await session.commit()
+    except Exception as ex:
+        await session.rollback()
+        raise ex
+
+    if result.rowcount:
+        invalidate_principal()
+
+    return result.rowcount
@@ -0,0 +1,51 @@
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+
+from database import AsyncSession
+from models.base import TableVersion
+
+
+def _bump_statement(name: str):
+    stmnt = insert(TableVersion).values(name=name, version=1)
+    return stmnt.on_conflict_do_update(
+        index_elements=[TableVersion.name],
+        set_={"version": TableVersion.version + 1},
+    )
+
+
+def get_version(session: Session, name: str) -> int:
+    stmnt = select(TableVersion.version).where(TableVersion.name == name)
+
+    version = session.exec(statement=stmnt).first()
+
+    return version or 0
+
+
+def get_versions(session: Session, *names: str) -> tuple[int, ...]:
+    """Versions of several counters in one query, in the order given"""
+    stmnt = select(TableVersion.name, TableVersion.version).where(
+        TableVersion.name.in_(names)
+    )
+
+    versions = dict(session.exec(statement=stmnt).all())
+
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def bump_version(session: Session, name: str):
+    """Bump the change counter of `name`, the caller commits"""
+    session.exec(_bump_statement(name))
+
+
+async def get_versions_async(session: AsyncSession, *names: str) -> tuple[int, ...]:
+    stmnt = select(TableVersion.name, TableVersion.version).where(
+        TableVersion.name.in_(names)
+    )
+
+    versions = dict((await session.exec(statement=stmnt)).all())
+
+    return tuple(versions.get(name, 0) for name in names)
+
+
+async def bump_version_async(session: AsyncSession, name: str):
+    await session.exec(_bump_statement(name))
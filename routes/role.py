@@ -2,52 +2,63 @@ from fastapi import (
     Depends,
     HTTPException,
     Request,
+    Response,
     status,
     APIRouter,
 )
-from sqlmodel import Session
-
-from database import get_session
-from models.base import RoleTypes, TokenData
+from database import AsyncSession, get_async_session
+from etag import etag_headers, etag_matches, make_etag, not_modified
+from models.base import TokenData
 from oauth import get_current_user
-from repository.role import delete_role, get_roles
+from repository.role import delete_role_async
+from repository.rolecatalog import role_catalog
 from settings import get_settings
 
 settings = get_settings()
 
 roleRouter = APIRouter(prefix="/api/role", tags=["Role"])
 
-adminUsers = [ut.name for ut in RoleTypes][:2]
-
 
 @roleRouter.get("/", summary="Get list of roles (json)")
-def api_get_roles(
-    session: Session = Depends(get_session),
+async def api_get_roles(
+    request: Request,
+    response: Response,
     user: TokenData = Depends(get_current_user),
 ):
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not Authorized",
         )
 
-    roles = get_roles(session)
+    etag = make_etag("api-role", role_catalog.version())
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    roles = role_catalog.roles()
+    response.headers.update(etag_headers(etag))
 
     return roles
 
 
 @roleRouter.delete("/{id}", summary="Delete a role")
-def api_delete_role(
+async def api_delete_role(
     id: int,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     user: TokenData = Depends(get_current_user),
 ):
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not Authorized",
         )
 
-    role = delete_role(session, id, user)
+    try:
+        role = await delete_role_async(session, id, user)
+    except Exception as ex:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(ex),
+        )
 
     return role
@@ -1,62 +1,308 @@
+import csv
+from datetime import datetime
+import io
+import json
+from typing import Literal
 from fastapi import (
     Depends,
     HTTPException,
     Request,
+    Response,
     status,
     APIRouter,
 )
+from fastapi.responses import StreamingResponse
 
-from sqlalchemy.orm import Session
-from database import get_session
-from models.base import RoleTypes, TokenData, UserShow, UserUpdate
+from database import AsyncSession, async_session_scope, get_async_session
+from etag import etag_headers, etag_matches, make_etag, not_modified
+from models.base import (
+    TokenData,
+    UserBulkUpdate,
+    UserSelection,
+    UserPage,
+    UserShow,
+    UserUpdate,
+)
 from oauth import get_current_user
 
-from repository.user import delete_user, get_users, update_user
+from repository.rolecatalog import role_catalog
+from repository.user import (
+    bulk_update_users_async,
+    delete_user_async,
+    get_users_page_async,
+    import_users_async,
+    stream_users_async,
+    update_user_async,
+)
+from repository.version import get_versions_async
 from settings import get_settings
 
 settings = get_settings()
 
 userRouter = APIRouter(prefix="/api/user", tags=["User"])
 
-adminUsers = [ut.name for ut in RoleTypes][:2]
+export_columns = (
+    "id",
+    "name",
+    "email",
+    "enabled",
+    "role_id",
+    "role",
+    "created_on",
+    "created_by",
+)
+
+export_media_types = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+    "csv": "text/csv",
+}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _export_chunk(batch, format: str, first: bool) -> str:
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if first:
+            writer.writerow(export_columns)
+        writer.writerows([row[col] for col in export_columns] for row in batch)
+        return buffer.getvalue()
+
+    lines = (json.dumps(dict(row), default=_json_default) for row in batch)
+    if format == "json":
+        return ("[" if first else ",") + ",".join(lines)
+    return "".join(line + "\n" for line in lines)
+
+
+async def _export_users(format: str):
+    first = True
+    async with async_session_scope() as session:
+        async for batch in stream_users_async(session):
+            yield _export_chunk(batch, format, first)
+            first = False
+    if format == "json":
+        yield "[]" if first else "]"
+    elif format == "csv" and first:
+        yield _export_chunk([], format, first)
+
+
+@userRouter.get("/", response_model=UserPage, summary="Get list of users (json)")
+async def api_get_users(
+    request: Request,
+    response: Response,
+    limit: int | None = None,
+    cursor: str | None = None,
+    order_by: str = "id",
+    session: AsyncSession = Depends(get_async_session),
+    user: TokenData = Depends(get_current_user),
+):
+    """Keyset paginated, pass the returned `next` as `cursor` to get the next
+    page (`next` is null on the last page). Answers `If-None-Match` with 304
+    while the user and role tables are unchanged"""
+
+    if not role_catalog.is_admin(user.role):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not Authorized",
+        )
+
+    versions = await get_versions_async(session, "user", "role")
+    etag = make_etag("api-user", *versions, limit, cursor, order_by)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    try:
+        users, next_cursor = await get_users_page_async(
+            session, limit, cursor, order_by
+        )
+    except ValueError as ex:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(ex),
+        )
+
+    response.headers.update(etag_headers(etag))
+
+    return {"items": users, "next": next_cursor}
+
+
+@userRouter.get("/export", summary="Stream all users (ndjson, json or csv)")
+async def api_export_users(
+    format: Literal["ndjson", "json", "csv"] = "ndjson",
+    user: TokenData = Depends(get_current_user),
+):
+    """Streams the whole user directory in batches from a server side cursor,
+    memory use does not grow with the number of users"""
+
+    if not role_catalog.is_admin(user.role):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not Authorized",
+        )
+
+    return StreamingResponse(
+        _export_users(format),
+        media_type=export_media_types[format],
+        headers={"Content-Disposition": f'attachment; filename="users.{format}"'},
+    )
+
+
+async def _read_import_body(request: Request) -> bytes:
+    """Request body, refused with 413 past USER_IMPORT_MAX_BYTES before it is
+    parsed (checked against Content-Length and again while reading, for
+    chunked bodies)"""
+    limit = settings.USER_IMPORT_MAX_BYTES
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"At most {limit} bytes per import",
+    )
+
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > limit:
+        raise too_large
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > limit:
+            raise too_large
+    return bytes(body)
+
 
+def _parse_import(body: bytes, format: str) -> list[dict]:
+    text = body.decode("utf-8-sig")
+    if format == "csv":
+        # empty cells fall back to the model defaults
+        return [
+            {key: value for key, value in row.items() if value not in ("", None)}
+            for row in csv.DictReader(io.StringIO(text))
+        ]
+    rows = json.loads(text)
+    if not isinstance(rows, list):
+        raise ValueError("Expected a JSON array of users")
+    return rows
 
-@userRouter.get("/", summary="Get list of users (json)")
-def api_get_users(
+
+@userRouter.post("/import", summary="Bulk create users from CSV or JSON")
+async def api_import_users(
     request: Request,
-    session: Session = Depends(get_session),
+    format: Literal["json", "csv"] | None = None,
+    session: AsyncSession = Depends(get_async_session),
     user: TokenData = Depends(get_current_user),
 ):
+    """Body is a JSON array or a CSV file with the columns name, email,
+    password, role_id and optionally enabled (the format defaults from the
+    Content-Type). Valid rows are created, the others are reported by row
+    number (1 based, header excluded)"""
+
+    if not role_catalog.is_admin(user.role):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not Authorized",
+        )
+
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if "csv" in content_type else "json"
+
+    body = await _read_import_body(request)
+
+    try:
+        rows = _parse_import(body, format)
+    except (ValueError, csv.Error) as ex:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid {format} body: {ex}",
+        )
+
+    if len(rows) > settings.USER_IMPORT_MAX_ROWS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {settings.USER_IMPORT_MAX_ROWS} users per import",
+        )
+
+    created, errors = await import_users_async(session, rows, user)
+
+    return {"created": created, "errors": errors}
+
+
+@userRouter.patch("/bulk", summary="Update many users in one statement")
+async def api_bulk_update_users(
+    bulk: UserBulkUpdate,
+    session: AsyncSession = Depends(get_async_session),
+    user: TokenData = Depends(get_current_user),
+):
+    """Sets `role_id` on every user matching `where` (ids, role_id, enabled,
+    email_domain, combined with AND)"""
+
+    if not role_catalog.is_admin(user.role):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not Authorized",
+        )
 
-    if user.role not in adminUsers:
+    try:
+        updated = await bulk_update_users_async(
+            session, bulk.where, bulk.set.model_dump(exclude_none=True), user
+        )
+    except Exception as ex:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(ex),
+        )
+
+    return {"updated": updated}
+
+
+@userRouter.post("/bulk/delete", summary="Delete many users in one statement")
+async def api_bulk_delete_users(
+    selection: UserSelection,
+    session: AsyncSession = Depends(get_async_session),
+    user: TokenData = Depends(get_current_user),
+):
+    if not role_catalog.is_admin(user.role):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not Authorized",
         )
 
-    users = get_users(session)
+    try:
+        deleted = await bulk_update_users_async(
+            session, selection, {"deleted": True}, user
+        )
+    except Exception as ex:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(ex),
+        )
 
-    return users
+    return {"deleted": deleted}
 
 
 @userRouter.patch(
     "/{id}", response_model=UserShow, summary="Update a user with a Pydantic model"
 )
-def api_save_user(
+async def api_save_user(
     id: int,
     upd_user: UserUpdate,
     request: Request,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     user: TokenData = Depends(get_current_user),
 ):
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not Authorized",
         )
 
     try:
-        edituser = update_user(session, id, upd_user, user)
+        edituser = await update_user_async(session, id, upd_user, user)
     except Exception as ex:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -67,20 +313,20 @@ def api_save_user(
 
 
 @userRouter.delete("/{id}", summary="Delete a user")
-def api_delete_user(
+async def api_delete_user(
     id: int,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     user: TokenData = Depends(get_current_user),
 ):
 
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not Authorized",
         )
 
     try:
-        user = delete_user(session, id, user)
+        user = await delete_user_async(session, id, user)
     except Exception as ex:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
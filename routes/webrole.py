@@ -8,23 +8,26 @@ from fastapi import (
 )
 from fastapi.applications import HTMLResponse
 from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
-from sqlmodel import Session, select
+from sqlmodel import Session
 from database import get_session
-from models.base import Role, RoleTypes, TokenData, User
+from etag import etag_headers, etag_matches, make_etag, not_modified
+from models.base import TokenData
 from oauth import get_current_user, get_current_user_from_cookie
-from repository.role import create_role, delete_role, get_roles
+from repository.bootstrap import is_initialized
+from repository.role import create_role, delete_role
+from repository.rolecatalog import role_catalog
+from logger import get_logger
 from settings import get_settings
+from templating import error_fragment, templates
 
 settings = get_settings()
 
 cookie_name = settings.COOKIE_NAME
 
-templates = Jinja2Templates(directory="www/templates")
+logger = get_logger(__name__)
 
-webroleRouter = APIRouter(prefix="/role", tags=["Web Role"])
 
-adminUsers = [ut.name for ut in RoleTypes][:2]
+webroleRouter = APIRouter(prefix="/role", tags=["Web Role"])
 
 
 @webroleRouter.get(
@@ -39,9 +42,7 @@ def web_get_users(
     user: TokenData = Depends(get_current_user_from_cookie),
 ):
 
-    adminUsers = [ut.name for ut in RoleTypes][:2]
-
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         errort = templates.TemplateResponse(
             request=request,
             name="error.html",
@@ -49,22 +50,24 @@ def web_get_users(
         )
         return errort
 
-    roles = get_roles(session)
+    etag = make_etag("web-role", role_catalog.version())
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    roles = role_catalog.roles()
 
     return templates.TemplateResponse(
         request=request,
         name="rolelist.html",
         context={"item": "Role", "list": roles},
+        headers=etag_headers(etag),
     )
 
 
 @webroleRouter.get("/create", response_class=HTMLResponse)
 def get_create_role_page(request: Request, session: Session = Depends(get_session)):
 
-    stmnt = select(User, Role).join(Role, isouter=True)
-    users: list[User] | None = session.exec(statement=stmnt).all()
-
-    if len(users) == 0:
+    if not is_initialized(session):
 
         # Create first super duper user
 
@@ -89,9 +92,9 @@ def get_create_role_page(request: Request, session: Session = Depends(get_sessio
         # redirect to login
         return RedirectResponse("/login")
 
-    user = get_current_user(cookie)
+    user = get_current_user(cookie, request)
 
-    print(user)
+    logger.debug("request principal: %s", user)
 
     # check if user is admin
     return templates.TemplateResponse(
@@ -110,27 +113,19 @@ def web_create_role(
 ):
 
     try:
-        _ = create_role(session, rolename, user)
+        newrole = create_role(session, rolename, user)
     except Exception as ex:
-        return f"Error {ex}"
-
-    # get cookie to check user
-    cookie = None
-
-    if request.cookies.get(cookie_name):
-        cookie = request.cookies.get(cookie_name)
-
-    if not cookie:
-        # redirect to login
-        return RedirectResponse("/login")
-
-    stmnt = select(Role)
-    roles = session.exec(statement=stmnt).all()
+        logger.warning("%s", ex)
+        message = "Some error (fix me!)"
+        if "UNIQUE constraint failed" in str(ex):
+            message = "Role already exists! Cannot add role."
+        return error_fragment(request, message, "#rolemessages")
 
+    # clears the form, the new row and the count are swapped in out-of-band
     return templates.TemplateResponse(
         request=request,
-        name="rolelist.html",
-        context={"item": "Role", "list": roles},
+        name="rolecreated.html",
+        context={"item": newrole, "count": len(role_catalog.roles())},
     )
 
 
@@ -141,22 +136,17 @@ def web_delete_role(
     session: Session = Depends(get_session),
     user: TokenData = Depends(get_current_user_from_cookie),
 ):
-    adminUsers = [ut.name for ut in RoleTypes][:2]
+    if not role_catalog.is_admin(user.role):
+        return error_fragment(request, "Not authorized!", "#rolemessages")
 
-    if user.role not in adminUsers:
-        errort = templates.TemplateResponse(
-            request=request,
-            name="error.html",
-            context={"error": "Not authorized!"},
-        )
-        return errort
-
-    _ = delete_role(session, id, user)
-
-    roles = get_roles(session)
+    try:
+        _ = delete_role(session, id, user)
+    except Exception as ex:
+        return error_fragment(request, str(ex), "#rolemessages")
 
+    # the empty main swap removes the row, the count is swapped in out-of-band
     return templates.TemplateResponse(
         request=request,
-        name="rolelist.html",
-        context={"item": "Role", "list": roles},
+        name="roledeleted.html",
+        context={"count": len(role_catalog.roles())},
     )
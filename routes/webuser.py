@@ -9,27 +9,43 @@ from fastapi import (
 )
 from fastapi.applications import HTMLResponse
 
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 from sqlmodel import select
-from database import get_session
-
-from models.base import Role, RoleTypes, TokenData, User, UserCreate, UserShow
-from oauth import create_access_token, get_current_user, get_current_user_from_cookie
+from database import AsyncSession, get_async_session, get_session
+from etag import etag_headers, etag_matches, make_etag, not_modified
+
+from models.base import Role, TokenData, User, UserCreate, UserShow
+from oauth import (
+    create_access_token,
+    get_current_user,
+    get_current_user_from_cookie,
+    principal_claims,
+)
 
-from repository.user import create_user, delete_user, get_users, update_user
+from repository.bootstrap import is_initialized, is_initialized_async
+from repository.rolecatalog import role_catalog
+from repository.user import (
+    count_users,
+    create_user_async,
+    delete_user,
+    get_users_page,
+    update_user,
+)
+from repository.version import get_versions
+from logger import get_logger
 from settings import get_settings
+from templating import count_changed, error_fragment, role_options, templates
 
 settings = get_settings()
 
 cookie_name = settings.COOKIE_NAME
 
-templates = Jinja2Templates(directory="www/templates")
+logger = get_logger(__name__)
 
-webuserRouter = APIRouter(prefix="/user", tags=["Web User"])
 
-adminUsers = [ut.name for ut in RoleTypes][:2]
+webuserRouter = APIRouter(prefix="/user", tags=["Web User"])
 
 
 @webuserRouter.get(
@@ -44,9 +60,7 @@ def web_get_users(
     user: TokenData = Depends(get_current_user_from_cookie),
 ):
 
-    adminUsers = [ut.name for ut in RoleTypes][:2]
-
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         errort = templates.TemplateResponse(
             request=request,
             name="error.html",
@@ -54,14 +68,63 @@ def web_get_users(
         )
         return errort
 
-    users = get_users(session)
+    etag = make_etag("web-user", *get_versions(session, "user", "role"))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    users, next_cursor = get_users_page(session)
 
     # accept = request.headers.get("accept")
 
     return templates.TemplateResponse(
         request=request,
         name="userlist.html",
-        context={"item": "User", "list": users, "morejsscripts": ""},
+        context={
+            "item": "User",
+            "list": users,
+            "next": next_cursor,
+            "count": count_users(session),
+            "morejsscripts": "",
+        },
+        headers=etag_headers(etag),
+    )
+
+
+@webuserRouter.get(
+    "/rows",
+    response_class=HTMLResponse,
+    include_in_schema=True,
+    summary="Get next page of user rows (html)",
+)
+def web_get_user_rows(
+    request: Request,
+    cursor: str | None = None,
+    session: Session = Depends(get_session),
+    user: TokenData = Depends(get_current_user_from_cookie),
+):
+
+    if not role_catalog.is_admin(user.role):
+        errort = templates.TemplateResponse(
+            request=request,
+            name="error.html",
+            context={"error": "Not authorized!"},
+        )
+        return errort
+
+    try:
+        users, next_cursor = get_users_page(session, cursor=cursor)
+    except ValueError as ex:
+        errort = templates.TemplateResponse(
+            request=request,
+            name="error.html",
+            context={"error": str(ex)},
+        )
+        return errort
+
+    return templates.TemplateResponse(
+        request=request,
+        name="userrows.html",
+        context={"list": users, "next": next_cursor},
     )
 
 
@@ -77,9 +140,7 @@ def web_edit_user(
     session: Session = Depends(get_session),
     user: TokenData = Depends(get_current_user_from_cookie),
 ):
-    adminUsers = [ut.name for ut in RoleTypes][:2]
-
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         errort = templates.TemplateResponse(
             request=request,
             name="error.html",
@@ -94,7 +155,7 @@ def web_edit_user(
         if not edituser:
             raise Exception("Not found")
     except Exception:
-        print("fik")
+        logger.debug("edit user %s not found", id)
         edituser: UserShow = UserShow(
             id=0,
             name="",
@@ -106,30 +167,11 @@ def web_edit_user(
         )
         pass
 
-    stmnt = select(Role)
-
-    roles = session.exec(statement=stmnt).all()
-
-    roleselect = """<select name="role" id="role">"""
-
-    for role in roles:
-        roleselect += f"""<option value="{role.id}" {"selected" if edituser.role_id == role.id else ""}>{role.name}</option>"""
-    roleselect += """</select>"""
-
-    htmledit = f"""<tr id="rowid_{edituser.id}">
-                    <td><input type='text' name="username" value="{edituser.name}" required /></td>
-                    <td><input type='email' name="useremail" value="{edituser.email}" required /></td>
-                    <td>{roleselect}</td>
-                    <td class="pointer" 
-                        hx-post="user/edit/{edituser.id}" 
-                        hx-target="#rowid_{edituser.id}" 
-                        hx-swap="outerHTML"
-                        hx-include="[name='username'],[name='useremail'],[name='role']"
-                        hx-on::before-request="document.getElementById('addbutton').disabled = false">✅</td>
-                    <td style="filter: grayscale(100%);" disabled>🗑</td>
-                </tr>"""
-
-    return htmledit
+    return templates.TemplateResponse(
+        request=request,
+        name="useredit.html",
+        context={"item": edituser, "role_options": role_options(edituser.role_id)},
+    )
 
 
 @webuserRouter.post(
@@ -147,9 +189,7 @@ def web_save_user(
     session: Session = Depends(get_session),
     user: TokenData = Depends(get_current_user_from_cookie),
 ):
-    adminUsers = [ut.name for ut in RoleTypes][:2]
-
-    if user.role not in adminUsers:
+    if not role_catalog.is_admin(user.role):
         errort = templates.TemplateResponse(
             request=request,
             name="error.html",
@@ -163,45 +203,28 @@ def web_save_user(
         role_id=int(role),
     )
 
-    errort = ""
+    message = ""
     try:
         edituser = update_user(session, id, updated_user, user)
     except Exception as ex:
-        print(ex)
+        logger.warning("%s", ex)
         message = str(ex.args)
         if "UNIQUE constraint failed" in str(ex):
             message = "User email already exists! Cannot save user."
         stmnt = select(User).join(Role, isouter=True).filter(User.id == id)
         edituser = session.exec(statement=stmnt).first()
-        errort = templates.TemplateResponse(
-            request=request,
-            name="error.html",
-            context={"error": message},
-        )
-        errort = errort.body.decode("utf-8")
-
-    htmledit = f"""<tr id="rowid_{edituser.id}">
-                    <td>{edituser.name}</td>
-                    <td>{edituser.email}</td>
-                    <td>{edituser.role.name}</td>
-                    <td class="pointer" 
-                        hx-get="user/edit/{edituser.id}" 
-                        hx-target="#rowid_{edituser.id}"
-                        hx-swap="outerHTML"
-                        hx-on::before-request="document.getElementById('addbutton').disabled = true">📝</td>
-                    <td class="pointer">🗑</td>
-                </tr>
-                {errort}
-                """
 
-    return htmledit
+    return templates.TemplateResponse(
+        request=request,
+        name="usersaved.html",
+        context={"item": edituser, "error": message},
+    )
 
 
 @webuserRouter.get("/create", response_class=HTMLResponse, include_in_schema=True)
 def get_create_user_page(request: Request, session: Session = Depends(get_session)):
 
-    stmnt = select(User, Role).join(Role, isouter=True)
-    users: list[User] | None = session.exec(statement=stmnt).all()
+    initialized = is_initialized(session)
 
     message = (
         ""
@@ -209,7 +232,7 @@ def get_create_user_page(request: Request, session: Session = Depends(get_sessio
         else request.query_params.get("message")
     )
 
-    if len(users) == 0:
+    if not initialized:
 
         # Create first super duper user
 
@@ -235,13 +258,11 @@ def get_create_user_page(request: Request, session: Session = Depends(get_sessio
         # redirect to login
         return RedirectResponse("/login")
 
-    user = get_current_user(cookie)
-
-    print(user)
+    user = get_current_user(cookie, request)
 
-    stmnt = select(Role)
+    logger.debug("request principal: %s", user)
 
-    roles = session.exec(statement=stmnt).all()
+    roles = role_catalog.roles()
 
     # check if user is admin
     return templates.TemplateResponse(
@@ -251,27 +272,24 @@ def get_create_user_page(request: Request, session: Session = Depends(get_sessio
             "title": "Create User",
             "roles": roles,
             "message": message,
-            "target": "#main",
+            "target": "#userform",
             "morejsscripts": "",
         },
     )
 
 
 @webuserRouter.post("/create", response_class=HTMLResponse, include_in_schema=True)
-def web_create_user(
+async def web_create_user(
     request: Request,
     role: Annotated[str, Form()],
     username: Annotated[str, Form()],
     useremail: Annotated[str, Form()],
     password: Annotated[str, Form()],
     rpassword: Annotated[str, Form()],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
 
-    stmnt = select(User, Role).join(Role, isouter=True)
-    users: list[User] | None = session.exec(statement=stmnt).all()
-
-    if len(users) == 0:
+    if not await is_initialized_async(session):
 
         new_user: UserCreate = UserCreate(
             name=username,
@@ -283,7 +301,7 @@ def web_create_user(
 
         errort = ""
         try:
-            newUser = create_user(
+            newUser = await create_user_async(
                 session,
                 new_user,
             )
@@ -318,16 +336,7 @@ def web_create_user(
                 },
             )
 
-        data = {
-            "sub": str(newUser.id),
-            "user_name": newUser.email,
-            "organization": "",
-            "orgid": 0,
-            "role": newUser.role.name,
-            "accepted_tc": None,
-            "impersonated": False,
-            "impersonated_by": None,
-        }
+        data = principal_claims(newUser.id, newUser.email, newUser.role.name)
 
         access_token = create_access_token(data)
 
@@ -353,7 +362,7 @@ def web_create_user(
         # redirect to login
         return RedirectResponse("/login")
 
-    user = get_current_user(cookie)
+    user = await run_in_threadpool(get_current_user, cookie, request)
 
     try:
         new_user: UserCreate = UserCreate(
@@ -364,34 +373,21 @@ def web_create_user(
             role_id=int(role),
         )
         # session.commit()
-        newUser = create_user(session, new_user, user)
-
-        errort = ""
+        newUser = await create_user_async(session, new_user, user)
     except Exception as ex:
-        print(ex)
-        if "UNIQUE constraint failed" in str(ex):
-            session.rollback()
+        logger.warning("%s", ex)
+        message = str(ex)
+        if "UNIQUE constraint failed" in message:
             message = "User email already exists! Cannot add user."
-        errort = templates.TemplateResponse(
-            request=request,
-            name="error.html",
-            context={"error": message},
-        )
-
-        errort = errort.body.decode("utf-8")
-
-    stmnt = select(User).join(Role, isouter=True)
-
-    users = session.exec(statement=stmnt).all()
+        return error_fragment(request, message, "#usermessages")
 
+    # clears the form, the new row is swapped in out-of-band and the page
+    # bumps its count
     return templates.TemplateResponse(
         request=request,
-        name="userlist.html",
-        context={
-            "item": "User",
-            "list": users,
-            "morejsscripts": errort,
-        },
+        name="usercreated.html",
+        context={"item": newUser},
+        headers=count_changed("user-count", 1),
     )
 
 
@@ -402,30 +398,13 @@ def web_delete_user(
     session: Session = Depends(get_session),
     user: TokenData = Depends(get_current_user_from_cookie),
 ):
-    adminUsers = [ut.name for ut in RoleTypes][:2]
-
-    if user.role not in adminUsers:
-        errort = templates.TemplateResponse(
-            request=request,
-            name="error.html",
-            context={"error": "Not authorized!"},
-        )
-        return errort
+    if not role_catalog.is_admin(user.role):
+        return error_fragment(request, "Not authorized!", "#usermessages")
 
     try:
         _ = delete_user(session, id, user)
     except Exception as ex:
-        errort = templates.TemplateResponse(
-            request=request,
-            name="error.html",
-            context={"error": str(ex)},
-        )
-        return errort
+        return error_fragment(request, str(ex), "#usermessages")
 
-    users = get_users(session)
-
-    return templates.TemplateResponse(
-        request=request,
-        name="userlist.html",
-        context={"item": "User", "list": users, "morejsscripts": ""},
-    )
+    # the empty main swap removes the row, the page lowers its count
+    return HTMLResponse("", headers=count_changed("user-count", -1))
@@ -0,0 +1,22 @@
+"""Production entry point, runs the app under gunicorn with the
+CustomUvicornWorker using gunicorn.conf.py
+
+    python serve.py [extra gunicorn args]
+"""
+
+import os
+import sys
+
+from gunicorn.app.wsgiapp import run
+
+
+def main():
+    config = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py"
+    )
+    sys.argv = ["gunicorn", "-c", config, *sys.argv[1:], "main:app"]
+    run()
+
+
+if __name__ == "__main__":
+    main()
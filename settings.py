@@ -10,12 +10,56 @@ class Settings(BaseSettings):
 
     JWT_SECRET: str = os.getenv("JWT_SECRET")
     JWT_ALGO: str = os.getenv("JWT_ALGO")
+    JWT_KEYS_DIR: str = os.getenv("JWT_KEYS_DIR", "datastore/keys")
+    JWT_ACTIVE_KID: str = os.getenv("JWT_ACTIVE_KID", "")
     JWT_EXPIRE: int = str(os.getenv("JWT_EXPIRE", 30))
     JWT_REFRESH_SECRET_KEY: str = os.getenv("JWT_REFRESH_SECRET_KEY")
     JWT_REFRESH_TOKEN_EXPIRE_MINUTES: int = str(
         os.getenv("JWT_REFRESH_TOKEN_EXPIRE_MINUTES", 300)
     )
     COOKIE_NAME: str = os.getenv("COOKIE_NAME")
+    REFRESH_COOKIE_NAME: str = os.getenv("REFRESH_COOKIE_NAME", "refresh_token")
+    REVOKED_CACHE_SIZE: int = os.getenv("REVOKED_CACHE_SIZE", 4096)
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    RATE_LIMIT_MAX_KEYS: int = os.getenv("RATE_LIMIT_MAX_KEYS", 10000)
+    LOGIN_RATE_IP: int = os.getenv("LOGIN_RATE_IP", 20)
+    LOGIN_RATE_USER: int = os.getenv("LOGIN_RATE_USER", 5)
+    LOGIN_RATE_WINDOW: int = os.getenv("LOGIN_RATE_WINDOW", 60)
+    PRINCIPAL_CACHE_TTL: int = os.getenv("PRINCIPAL_CACHE_TTL", 60)
+    PRINCIPAL_CACHE_SIZE: int = os.getenv("PRINCIPAL_CACHE_SIZE", 1024)
+    PASSWORD_EXECUTOR: str = os.getenv("PASSWORD_EXECUTOR", "thread")
+    PASSWORD_WORKERS: int = os.getenv("PASSWORD_WORKERS", 2)
+    BCRYPT_ROUNDS: int = os.getenv("BCRYPT_ROUNDS", 12)
+    DB_POOL_SIZE: int = os.getenv("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW: int = os.getenv("DB_MAX_OVERFLOW", 10)
+    DB_POOL_TIMEOUT: int = os.getenv("DB_POOL_TIMEOUT", 30)
+    DB_POOL_RECYCLE: int = os.getenv("DB_POOL_RECYCLE", -1)
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", False)
+    SQLITE_JOURNAL_MODE: str = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+    SQLITE_SYNCHRONOUS: str = os.getenv("SQLITE_SYNCHRONOUS", "normal")
+    SQLITE_CACHE_SIZE: int = os.getenv("SQLITE_CACHE_SIZE", -20000)
+    SQLITE_MMAP_SIZE: int = os.getenv("SQLITE_MMAP_SIZE", 268435456)
+    SQLITE_TEMP_STORE: str = os.getenv("SQLITE_TEMP_STORE", "memory")
+    SQLITE_BUSY_TIMEOUT: int = os.getenv("SQLITE_BUSY_TIMEOUT", 5000)
+    ROLE_CATALOG_CHECK_INTERVAL: int = os.getenv("ROLE_CATALOG_CHECK_INTERVAL", 5)
+    USER_PAGE_SIZE: int = os.getenv("USER_PAGE_SIZE", 50)
+    USER_PAGE_MAX: int = os.getenv("USER_PAGE_MAX", 500)
+    USER_EXPORT_BATCH: int = os.getenv("USER_EXPORT_BATCH", 500)
+    USER_IMPORT_BATCH: int = os.getenv("USER_IMPORT_BATCH", 500)
+    USER_IMPORT_MAX_ROWS: int = os.getenv("USER_IMPORT_MAX_ROWS", 10000)
+    USER_IMPORT_MAX_BYTES: int = os.getenv("USER_IMPORT_MAX_BYTES", 5242880)
+    IMPORT_HASH_WORKERS: int = os.getenv("IMPORT_HASH_WORKERS", os.cpu_count() or 2)
+    DEV_MODE: bool = os.getenv("DEV_MODE", True)
+    TEMPLATE_CACHE_DIR: str = os.getenv("TEMPLATE_CACHE_DIR", "datastore/jinja_cache")
+    # timings reveal internals, only on by default in development
+    SERVER_TIMING: bool = os.getenv("SERVER_TIMING", os.getenv("DEV_MODE", True))
+    METRICS_DIR: str = os.getenv("METRICS_DIR", "")
+    # bearer token for /metrics scrapers, without it /metrics is dev only
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")
+    METRICS_FLUSH_INTERVAL: int = os.getenv("METRICS_FLUSH_INTERVAL", 5)
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    LOG_JSON: bool = os.getenv("LOG_JSON", False)
+    SQL_ECHO: bool = os.getenv("SQL_ECHO", False)
 
 
 @lru_cache()
@@ -0,0 +1,89 @@
+import json
+import os
+
+from fastapi.templating import Jinja2Templates
+import jinja2
+from markupsafe import Markup, escape
+
+from logger import get_logger
+from repository.rolecatalog import role_catalog
+from settings import get_settings
+from timing import TimedTemplate
+
+settings = get_settings()
+
+logger = get_logger(__name__)
+
+template_directory = "www/templates"
+
+
+def _bytecode_cache() -> jinja2.BytecodeCache | None:
+    if not settings.TEMPLATE_CACHE_DIR:
+        return None
+    os.makedirs(settings.TEMPLATE_CACHE_DIR, exist_ok=True)
+    return jinja2.FileSystemBytecodeCache(settings.TEMPLATE_CACHE_DIR)
+
+
+# one environment (and template cache) shared by every router. Outside dev
+# mode templates are never re-checked on disk, and the compiled bytecode is
+# kept on disk so new workers skip the compile step
+env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(template_directory),
+    autoescape=True,
+    auto_reload=settings.DEV_MODE,
+    bytecode_cache=_bytecode_cache(),
+)
+env.template_class = TimedTemplate
+
+templates = Jinja2Templates(env=env)
+
+
+def error_fragment(request, error: str, target: str):
+    """error.html retargeted (via HX-Retarget) into `target`, for mutations
+    whose normal swap target is a single row"""
+    return templates.TemplateResponse(
+        request=request,
+        name="error.html",
+        context={"error": error},
+        headers={"HX-Retarget": target, "HX-Reswap": "innerHTML"},
+    )
+
+
+def count_changed(event: str, delta: int) -> dict[str, str]:
+    """HX-Trigger header raising `event` with `delta` as its value, the list
+    page adjusts its count badge without the server counting the rows"""
+    return {"HX-Trigger": json.dumps({event: delta})}
+
+
+def precompile_templates():
+    """Load every template into the environment cache (called at startup)"""
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    logger.info("precompiled %s templates", len(names))
+
+
+# (roles snapshot, {role id: (option, selected option)}), rebuilt when the
+# role catalog hands out a new snapshot
+_role_options = None
+
+
+def role_options(selected_id: int | None = None) -> Markup:
+    """<option> markup for every role, with `selected_id` selected"""
+    global _role_options
+    roles = role_catalog.roles()
+    cached = _role_options
+    if cached is None or cached[0] is not roles:
+        options = {}
+        for role in roles:
+            value, name = escape(role.id), escape(role.name)
+            options[role.id] = (
+                Markup(f'<option value="{value}">{name}</option>'),
+                Markup(f'<option value="{value}" selected>{name}</option>'),
+            )
+        cached = _role_options = (roles, options)
+
+    return Markup("").join(
+        option[1] if role_id == selected_id else option[0]
+        for role_id, option in cached[1].items()
+    )
@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+
+import jinja2
+
+# stage -> [total seconds, count] for the request being served
+_timings: ContextVar[dict | None] = ContextVar("server_timings", default=None)
+
+
+def start_timings():
+    """Start collecting stage timings for the current request, returns the
+    token to pass to `stop_timings`"""
+    return _timings.set({})
+
+
+def stop_timings(token):
+    _timings.reset(token)
+
+
+def current_timings() -> dict | None:
+    return _timings.get()
+
+
+def add_timing(stage: str, duration: float):
+    timings = _timings.get()
+    if timings is None:
+        return
+    entry = timings.get(stage)
+    if entry is None:
+        timings[stage] = [duration, 1]
+    else:
+        entry[0] += duration
+        entry[1] += 1
+
+
+@contextmanager
+def timed(stage: str):
+    if _timings.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(stage, time.perf_counter() - start)
+
+
+def server_timing_header(timings: dict, total: float) -> str:
+    """Server-Timing value, durations in milliseconds"""
+    parts = []
+    for stage, (duration, count) in timings.items():
+        part = f"{stage};dur={duration * 1000:.3f}"
+        if count > 1:
+            part += f';desc="{count}x"'
+        parts.append(part)
+    parts.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(parts)
+
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        with timed("render"):
+            return super().render(*args, **kwargs)
@@ -1,16 +1,31 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from threading import Lock
+import time
 import bcrypt
 
+from metrics import password_seconds
+from settings import get_settings
+from timing import timed
+
+settings = get_settings()
+
+_password_executor: Executor | None = None
+_password_executor_lock = Lock()
+_import_executor: Executor | None = None
+
 
 # Hash a password using bcrypt
-def hash_password(password):
+def _hash_password(password):
     pwd_bytes = password.encode("utf-8")
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS)
     hashed_password = bcrypt.hashpw(password=pwd_bytes, salt=salt)
     return hashed_password
 
 
 # Check if the provided password matches the stored password (hashed)
-def verify_password(plain_password, hashed_password) -> bool:
+def _verify_password(plain_password, hashed_password) -> bool:
     password_byte_enc = bytes(plain_password.encode("utf-8"))
     try:
         if not isinstance(hashed_password, (bytes, bytearray)):
@@ -24,3 +39,114 @@ def verify_password(plain_password, hashed_password) -> bool:
         )
     except Exception:
         return False
+
+
+def _hash_passwords(passwords: list[str]) -> list[bytes]:
+    return [_hash_password(password) for password in passwords]
+
+
+# Check if a stored hash was made with a different cost than the configured one
+def needs_rehash(hashed_password) -> bool:
+    if isinstance(hashed_password, (bytes, bytearray)):
+        hashed_password = hashed_password.decode("utf-8", errors="ignore")
+    try:
+        rounds = int(hashed_password.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return True
+    return rounds != settings.BCRYPT_ROUNDS
+
+
+def _process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """The workers are not forked from the (threaded) app process, they start
+    from a clean forkserver (spawn where that is not available), so they
+    inherit no locks, pooled connections or the logging thread"""
+    method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context(method)
+    )
+
+
+def get_password_executor() -> Executor:
+    """Dedicated bounded pool for bcrypt work, so password checks never
+    occupy the threadpool shared by sync routes"""
+    global _password_executor
+    if _password_executor is None:
+        with _password_executor_lock:
+            if _password_executor is None:
+                if settings.PASSWORD_EXECUTOR == "process":
+                    _password_executor = _process_pool(settings.PASSWORD_WORKERS)
+                else:
+                    _password_executor = ThreadPoolExecutor(
+                        max_workers=settings.PASSWORD_WORKERS,
+                        thread_name_prefix="password",
+                    )
+    return _password_executor
+
+
+def get_import_executor() -> Executor:
+    """Process pool for bulk imports, kept apart from the login executor so an
+    import never delays interactive password checks"""
+    global _import_executor
+    if _import_executor is None:
+        with _password_executor_lock:
+            if _import_executor is None:
+                _import_executor = _process_pool(settings.IMPORT_HASH_WORKERS)
+    return _import_executor
+
+
+def shutdown_password_executor():
+    global _password_executor, _import_executor
+    with _password_executor_lock:
+        if _password_executor is not None:
+            _password_executor.shutdown(wait=False, cancel_futures=True)
+            _password_executor = None
+        if _import_executor is not None:
+            _import_executor.shutdown(wait=False, cancel_futures=True)
+            _import_executor = None
+
+
+# the executor does not carry the request context (and may be another
+# process), so the time (including the wait for a free worker) is recorded here
+async def hash_password_async(password):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    with timed("bcrypt"):
+        hashed_password = await loop.run_in_executor(
+            get_password_executor(), _hash_password, password
+        )
+    password_seconds.observe(time.perf_counter() - start, operation="hash")
+    return hashed_password
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    with timed("bcrypt"):
+        result = await loop.run_in_executor(
+            get_password_executor(), _verify_password, plain_password, hashed_password
+        )
+    password_seconds.observe(time.perf_counter() - start, operation="verify")
+    return result
+
+
+async def hash_passwords_async(passwords: list[str], chunk_size: int = 32) -> list:
+    """Hash many passwords on the import process pool, in chunks to keep the
+    pickling overhead per password low"""
+    loop = asyncio.get_running_loop()
+    executor = get_import_executor()
+    start = time.perf_counter()
+    with timed("bcrypt"):
+        chunks = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    executor, _hash_passwords, passwords[i : i + chunk_size]
+                )
+                for i in range(0, len(passwords), chunk_size)
+            )
+        )
+    password_seconds.observe(time.perf_counter() - start, operation="hash_bulk")
+    return [hashed for chunk in chunks for hashed in chunk]
@@ -1,5 +1,14 @@
-from uvicorn.workers import UvicornWorker
+try:
+    from uvicorn_worker import UvicornWorker
+except ImportError:
+    from uvicorn.workers import UvicornWorker
 
 
 class CustomUvicornWorker(UvicornWorker):
-    CONFIG_KWARGS = {"loop": "auto", "http": "auto", "server_header": False}
+    # "auto" picks uvloop and httptools when they are installed and falls
+    # back to asyncio and h11 otherwise
+    CONFIG_KWARGS = {
+        "loop": "auto",
+        "http": "auto",
+        "server_header": False,
+    }